@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''
+Benchmarks for mock data generation.
+
+Run `python benchmark.py -h` for the list of benchmarks.
+'''
+from __future__ import division
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+import numpy as np
+
+import mockdata
+from mockdata import scatter, bilinear, resonance
+from mockdata.mock_bg import _nextpow2
+from mockdata.planner import estimate_memory
+
+# Accepted range of the planner's peak memory estimate over the measured
+# peak: never below it, and at most 25% above
+memory_tolerance = (1.0, 1.25)
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Run `func`, returning its result, wall time and peak traced memory.
+    '''
+    tracemalloc.start()
+    tic = time.time()
+    result = func(*args, **kwargs)
+    elapsed = time.time() - tic
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_memory(sec, fs):
+    '''
+    Check the planner's peak memory estimates against the peaks measured
+    with tracemalloc, for serial and chunked generation (in blocks of an
+    eighth of the data). Exits with an error if the estimate over the
+    measured peak is outside `memory_tolerance` for any case.
+    '''
+    cases = [
+        ('scatter', []),
+        ('scatter', ['-r', '8']),
+        ('scatter', ['-r', '1', '-i', '12']),
+        ('scatter', ['-r', '4', '-i', '6', '-f']),
+        ('scatter', ['-p', '-r', '6']),
+        ('scatter', ['-i', '6', '-d']),
+        ('scatter', ['-i', '12', '-d', '-f']),
+        ('scatter', ['-i', '6', '-n', '1e-9']),
+        ('scatter', ['-r', '4', '-i', '6', '-d', '-n', '1e-9', '-f']),
+        ('bilinear', []),
+        ('bilinear', ['-p', '2']),
+        ('bilinear', ['-p', '4']),
+        ('bilinear', ['-p', '8']),
+        ('resonance', []),
+        ('resonance', ['-f', '10', '20', '40']),
+        ('resonance', ['-f', '10', '20', '40', '80', '160', '320']),
+    ]
+    print('{:<10} {:<36} {:>8} {:>10} {:>10} {:>7}'.format(
+        'model', 'keywords', 'mode', 'estimate', 'measured', 'ratio'))
+    failed = []
+    for model, keywords in cases:
+        for chunked in (False, True):
+            estimate = estimate_memory(sec, fs, model, keywords,
+                                       chunked=chunked, block_sec=sec / 8)
+            if chunked:
+                func = mockdata.chunked_starting_data
+                kwargs = {'block_sec': sec / 8, 'workers': 1}
+            else:
+                func = mockdata.starting_data
+                kwargs = {}
+            # Measure the transfer functions being computed, not reused
+            resonance.transfer_function.cache_clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, _, peak = measure(func, sec, fs, model, seed=1,
+                                     parse_str=keywords, **kwargs)
+            ratio = estimate['peak'] / peak
+            mode = 'chunked' if chunked else 'serial'
+            ok = memory_tolerance[0] <= ratio <= memory_tolerance[1]
+            if not ok:
+                failed.append('{} {} ({})'.format(model, ' '.join(keywords),
+                                                  mode))
+            print('{:<10} {:<36} {:>8} {:>9.1f}M {:>9.1f}M {:>7.2f}{}'.format(
+                model, ' '.join(keywords), mode, estimate['peak'] / 2**20,
+                peak / 2**20, ratio, '' if ok else '  *'))
+    if failed:
+        raise SystemExit('Estimates outside {} of the measured peak: '
+                         '{}'.format(memory_tolerance, ', '.join(failed)))
+
+
+def bench_channels(sec, fs):
+    '''
+    Time and peak memory of scatter witness generation against the number
+    of irrelevant channels.
+    '''
+    modes = [
+        ('tiled', _tiled_witness, {}),
+        ('matrix', scatter.witness, {}),
+        ('views', scatter.witness, {'views': True}),
+        ('distinct', scatter.witness, {'distinct_irrelevant': True}),
+    ]
+    print('{:>8} {:>9} {:>9} {:>10}'.format('channels', 'mode', 'time',
+                                          'peak'))
+    for n_irrelevant in (10, 100, 1000):
+        for name, func, kwargs in modes:
+            _, elapsed, peak = measure(func, 2, n_irrelevant, sec=sec,
+                                       fs=fs, seed=1, **kwargs)
+            print('{:>8} {:>9} {:>8.2f}s {:>9.1f}M'.format(
+                n_irrelevant, name, elapsed, peak / 2**20))
+
+
+def _tiled_witness(n_relevant, n_irrelevant, sec, fs, seed):
+    '''
+    Witness matrix built the old way, by tiling the seismic channels,
+    adding zero-scaled noise and concatenating, as a baseline.
+    '''
+    state = np.random.RandomState(seed)
+    (b1, a1), _ = scatter._seismic_filters(fs)
+    y1 = 5e-7*scatter.sig.lfilter(b1, a1, state.randn(sec*fs))
+    y1_irr = 5e-7*scatter.sig.lfilter(b1, a1, state.randn(sec*fs))
+    rel_1 = (n_relevant+1)//2
+    irrel_1 = (n_irrelevant+1)//2
+    wits = np.concatenate((np.tile(y1, (rel_1, 1)),
+                           np.tile(y1_irr, (irrel_1, 1))), 0)
+    noise = 0.0*5e-11*state.randn(rel_1+irrel_1, sec*fs)
+    noise *= state.uniform(low=0.1, high=1.0, size=(rel_1+irrel_1, 1))
+    wits += noise
+    rel_2 = n_relevant//2
+    irrel_2 = n_irrelevant//2
+    wits_2 = np.concatenate((
+        scatter._sine_wits(sec*fs, fs, 59.5, 119.7, 0.8 + np.zeros(rel_2),
+                           0.32 + np.zeros(rel_2)),
+        scatter._sine_wits(sec*fs, fs, 71.2, 143.0,
+                           2*np.pi*state.uniform(size=irrel_2),
+                           2*np.pi*state.uniform(size=irrel_2))), 0)
+    return np.concatenate((wits, wits_2), 0)
+
+
+def bench_assembly(sec, fs):
+    '''
+    Peak memory of the target assembly steps: the coupling functions, the
+    background and the final sum, computed the old allocating way, in
+    place, and into a preallocated output. Peaks are in full-length
+    arrays, inputs not included.
+    '''
+    N = sec * fs
+    state = np.random.RandomState(1)
+    y1 = 1e-6 * state.randn(N)
+    y2 = 1e-7 * state.randn(N)
+    motion = state.randn(2, N)
+    background = state.randn(N)
+    coupled = state.randn(N)
+    out = np.empty(N)
+
+    cases = [
+        ('scatter coupling', lambda: _allocating_scatter(y1, y2),
+         lambda: scatter.coupling_func(y1, y2),
+         lambda: scatter.coupling_func(y1, y2, out=out)),
+        ('bilinear coupling', lambda: np.prod(tuple(motion), axis=0),
+         lambda: bilinear.coupling_func(motion),
+         lambda: bilinear.coupling_func(motion, out=out)),
+        ('bucket_noise', lambda: _allocating_bucket_noise(sec, fs, 1),
+         lambda: mockdata.bucket_noise(sec, fs, seed=1),
+         lambda: mockdata.bucket_noise(sec, fs, seed=1, out=out)),
+        ('get_lines', None, lambda: mockdata.get_lines(sec, fs, seed=1),
+         lambda: mockdata.get_lines(sec, fs, seed=1, out=out)),
+        ('target sum', lambda: coupled + background,
+         lambda: np.add(coupled, background, out=coupled), None),
+    ]
+    print('{:<18} {:>10} {:>10} {:>10}'.format('step', 'allocating',
+                                              'in place', 'out='))
+    for name, allocating, in_place, into in cases:
+        peaks = []
+        for func in (allocating, in_place, into):
+            if func is None:
+                peaks.append('{:>10}'.format('-'))
+                continue
+            _, _, peak = measure(func)
+            peaks.append('{:>10.2f}'.format(peak / (8 * N)))
+        print('{:<18} {}'.format(name, ' '.join(peaks)))
+
+
+def _allocating_scatter(y1, y2, scale=3e-18, phi=0):
+    '''
+    Scatter coupling as one expression with its temporaries, as a baseline.
+    '''
+    return scale*np.sin(2*2*np.pi/scatter.lambduh*(y1 + y2) + phi)
+
+
+def _allocating_bucket_noise(sec, fs, seed):
+    '''
+    `bucket_noise` with its default shape built from stacked (root,
+    frequency) arrays and out-of-place products, as a baseline.
+    '''
+    state = np.random.RandomState(seed)
+    N = sec * fs
+    Nfft = _nextpow2(N)
+    nscale = fs * np.sqrt(Nfft / fs / 2)
+    angles = state.uniform(low=-np.pi, high=np.pi, size=Nfft // 2)
+    rfft_data = np.zeros(Nfft // 2 + 1, dtype=np.complex128)
+    rfft_data[1:] = nscale * np.exp(1j * angles)
+    freqs = np.fft.rfftfreq(Nfft, d=1 / fs)
+    poles = -1j * np.asarray([5] * 2)[:, np.newaxis]
+    zeros = -1j * np.asarray([24] * 2 + [350])[:, np.newaxis]
+    norm = 2.2e-20 * np.prod(100 - poles) / np.prod(100 - zeros)
+    shape = norm * (np.prod(freqs - zeros, axis=0) /
+                    np.prod(freqs - poles, axis=0))
+    return np.fft.irfft(rfft_data * shape)[:N]
+
+
+benchmarks = {
+    'assembly': bench_assembly,
+    'channels': bench_channels,
+    'memory': bench_memory,
+}
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('benchmark', choices=sorted(benchmarks),
+                    help='Benchmark to run.')
+parser.add_argument('-t', '--sec', default=64, type=int,
+                    help='Seconds of data to generate. Defaults to '
+                         '%(default)s')
+parser.add_argument('-f', '--fs', default=2048, type=int,
+                    help='Sampling frequency in Hz. Defaults to '
+                         '%(default)s')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args.sec, args.fs)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 from __future__ import division
+import os
 import sys
+import json
+import time
+import hashlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from mockdata import starting_data, plot_asd, known_models
+from mockdata import save_container, container_ext
 from scipy.io import savemat
 import numpy as np
 
@@ -38,52 +44,206 @@ parser.add_argument('-d', '--doshift', action='store_true', default=False,
 parser.add_argument('-s', '--shift', default=0.5, type=float, nargs='?',
                     help='Time shift in seconds.')
 
-
-
-# Get parameters into global namespace
-args   = parser.parse_args()
-model  = args.model
-sec    = args.sec
-fs     = args.fs
-doplot = args.doplot
-doshift = args.doshift
-shift = args.shift
-keyword_list = args.keywords
-
-times, background, darm, wit, aux = starting_data(sec=sec, fs=fs,
-                                                  model = model,
-                                                  parse_str=keyword_list)
-
-if doshift:
-    idx = np.mod(np.arange(len(darm),) + int(shift*fs),len(darm))
-    darm = darm[idx]
-
-noise_data = {}
-noise_data['times']      = times   # just the time array
-noise_data['fs']         = fs
-noise_data['darm']       = darm     # this is background + nonlin noise
-noise_data['wit']        = wit
-noise_data['background'] = background
-noise_data.update(aux)
-
-# save the dictionary of data into a HDF5 .mat file so that
-# its readable in matlab and python
-
-if doshift:
-    filename = 'DARM_shift_with_{}'.format(model)
-else:
-    filename = 'DARM_with_{}'.format(model)
-savemat(filename, noise_data,
-        appendmat      = True,
-        do_compression = True)
-
-if doplot:
-    import matplotlib.pyplot as plt
-    plt.style.use('ggplot')
-
-    if 'ideal_estimate' in aux:
-        est = aux['ideal_estimate']
+parser.add_argument('--save-times', action='store_true', default=False,
+                    help='Also save the full array of sample times. By '
+                         'default only t0 and fs are saved.')
+
+parser.add_argument('--format', default='mat', choices=['mat', 'mdc'],
+                    help="Output format: a compressed .mat file, or 'mdc', "
+                         "a chunked container compressed in parallel whose "
+                         "channels and time ranges can be read separately "
+                         "(see mockdata.container). Defaults to %(default)s.")
+
+parser.add_argument('-m', '--manifest', default=None, type=str,
+                    help='JSON file listing jobs to run in one worker pool '
+                         'instead of a single model. Each job may give '
+                         'model, sec, fs, seed, keywords, shift, format and '
+                         'output; '
+                         'jobs whose output exists are skipped.')
+
+parser.add_argument('-w', '--workers', default=1, type=int,
+                    help='Number of worker processes in manifest mode. '
+                         'Defaults to %(default)s.')
+
+
+def make_noise(model, sec, fs, keyword_list=[], shift=None, seed=None,
+               save_times=False, filename=None, fmt='mat'):
+    '''
+    Generate one data set and save it to `filename` (by default named
+    after the model) in format `fmt`, 'mat' or 'mdc'. If `shift` is
+    given, the target is circularly shifted by that many seconds. Returns
+    the file name, the arrays needed for plotting, and the generation and
+    saving times.
+    '''
+    start = time.time()
+    times, background, darm, wit, aux = starting_data(sec=sec, fs=fs,
+                                                      model = model,
+                                                      seed=seed,
+                                                      parse_str=keyword_list)
+
+    if shift is not None:
+        idx = np.mod(np.arange(len(darm),) + int(shift*fs),len(darm))
+        darm = darm[idx]
+
+    noise_data = {}
+    noise_data['t0']         = times.t0  # times are t0 + arange(N) / fs
+    noise_data['fs']         = fs
+    if save_times:
+        noise_data['times']  = np.asarray(times)
+    noise_data['darm']       = darm     # this is background + nonlin noise
+    noise_data['wit']        = wit
+    noise_data['background'] = background
+    noise_data.update(aux)
+    generated = time.time()
+
+    # save the dictionary of data into a HDF5 .mat file so that
+    # its readable in matlab and python
+
+    if filename is None:
+        if shift is not None:
+            filename = 'DARM_shift_with_{}'.format(model)
+        else:
+            filename = 'DARM_with_{}'.format(model)
+    if fmt == 'mdc':
+        filename = save_container(filename, noise_data)
     else:
-        est = None
-
-    plot_asd(background, darm, est, fs=fs, model=model)
+        savemat(filename, noise_data,
+                appendmat      = True,
+                do_compression = True)
+
+    est = noise_data.get('ideal_estimate')
+    return (filename, (background, darm, est),
+            generated - start, time.time() - generated)
+
+
+def read_manifest(manifest):
+    '''
+    List of jobs of a manifest: either a JSON list of job objects, or an
+    object with a 'jobs' list and 'defaults' shared by all jobs. Jobs get
+    a default 'output' name from their contents, so reruns find them.
+    '''
+    with open(manifest) as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+
+    jobs = []
+    for job in spec['jobs']:
+        job = dict(spec.get('defaults', {}), **job)
+        job.setdefault('model', 'scatter')
+        job.setdefault('sec', 16)
+        job.setdefault('fs', 1024)
+        job.setdefault('seed', None)
+        job.setdefault('shift', None)
+        keywords = job.get('keywords', [])
+        if not isinstance(keywords, list):
+            keywords = keywords.split()
+        job['keywords'] = [str(word) for word in keywords]
+        if 'output' not in job:
+            blob = json.dumps(job, sort_keys=True).encode('utf-8')
+            job['output'] = 'DARM{}_with_{}_{}'.format(
+                '_shift' if job['shift'] is not None else '', job['model'],
+                hashlib.sha1(blob).hexdigest()[:8])
+        jobs.append(job)
+    return jobs
+
+
+def run_job(job, save_times=False):
+    '''
+    Run one manifest job, returning its summary. Errors are reported
+    rather than raised, so one bad job does not stop the others.
+    '''
+    try:
+        _, _, t_gen, t_save = make_noise(
+            job['model'], job['sec'], job['fs'], job['keywords'],
+            shift=job['shift'], seed=job['seed'], save_times=save_times,
+            filename=job['output'], fmt=job.get('format', 'mat'))
+    except SystemExit:
+        # The model keyword parser has printed what was wrong
+        return {'status': 'failed',
+                'error': 'Invalid keywords: {}'.format(job['keywords'])}
+    except Exception as e:
+        return {'status': 'failed', 'error': repr(e)}
+    return {'status': 'done', 'generate': t_gen, 'save': t_save}
+
+
+def run_manifest(manifest, workers=1, save_times=False):
+    '''
+    Run the jobs of a manifest in a pool of `workers` processes, skipping
+    those whose output exists, and print a timing summary. Returns the
+    number of failed jobs.
+    '''
+    jobs = read_manifest(manifest)
+    start = time.time()
+
+    results = [None] * len(jobs)
+    todo = []
+    for ii, job in enumerate(jobs):
+        name = job['output']
+        ext = container_ext if job.get('format') == 'mdc' else '.mat'
+        if os.path.exists(name) or os.path.exists(name + ext):
+            results[ii] = {'status': 'skipped'}
+        else:
+            todo.append(ii)
+
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(min(workers, len(todo))) as pool:
+            done = pool.map(run_job, [jobs[ii] for ii in todo],
+                            [save_times] * len(todo))
+            for ii, result in zip(todo, done):
+                results[ii] = result
+    else:
+        for ii in todo:
+            results[ii] = run_job(jobs[ii], save_times)
+    wall = time.time() - start
+
+    print('{:<4} {:<36} {:<10} {:>9} {:>9} {:>9}'.format(
+        'job', 'output', 'model', 'gen [s]', 'save [s]', 'total [s]'))
+    busy = 0
+    for ii, (job, result) in enumerate(zip(jobs, results)):
+        if result['status'] == 'done':
+            total = result['generate'] + result['save']
+            busy += total
+            times = '{:9.2f} {:9.2f} {:9.2f}'.format(
+                result['generate'], result['save'], total)
+        else:
+            times = '{:>29}'.format(result['status'])
+        print('{:<4} {:<36} {:<10} {}'.format(ii, job['output'],
+                                              job['model'], times))
+        if result['status'] == 'failed':
+            print('     {}'.format(result['error']))
+
+    counts = {status: sum(1 for r in results if r['status'] == status)
+              for status in ('done', 'skipped', 'failed')}
+    print('{done} done, {skipped} skipped, {failed} failed'.format(**counts) +
+          ' in {:.2f} s wall time ({:.2f} s of job time, {} workers)'.format(
+              wall, busy, workers))
+    return counts['failed']
+
+
+if __name__ == '__main__':
+    # Get parameters into global namespace
+    args   = parser.parse_args()
+    model  = args.model
+    sec    = args.sec
+    fs     = args.fs
+    doplot = args.doplot
+    doshift = args.doshift
+    shift = args.shift
+    keyword_list = args.keywords
+    save_times = args.save_times
+
+    if args.manifest is not None:
+        failed = run_manifest(args.manifest, workers=args.workers,
+                              save_times=save_times)
+        sys.exit(1 if failed else 0)
+
+    filename, (background, darm, est), _, _ = make_noise(
+        model, sec, fs, keyword_list, shift=shift if doshift else None,
+        save_times=save_times, fmt=args.format)
+
+    if doplot:
+        import matplotlib.pyplot as plt
+        plt.style.use('ggplot')
+
+        plot_asd(background, darm, est, fs=fs, model=model)
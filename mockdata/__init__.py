@@ -1,3 +1,18 @@
+from .timeaxis import *
+from .lazyaux import *
 from .mock_bg import *
+from .tabulated import *
+from .lines import *
+from .sinusoids import *
+from .glitches import *
 from .mock_noise import *
+from .loader import *
+from .chunked import *
+from .sweep import *
+from .network import *
+from .frames import *
+from .container import *
+from .service import *
+from .validate import *
+from .scoring import *
 from .plots import *
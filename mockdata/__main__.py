@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Command line entry points of the package, run as ``python -m mockdata``.
+'''
+from __future__ import division
+import argparse
+import sys
+
+
+def _serve(args):
+    from .service import serve
+    serve(host=args.host, port=args.port, cache_dir=args.cache_dir,
+          workers=args.workers, max_queue=args.max_queue,
+          backend=args.backend, quiet=args.quiet)
+
+
+def _validate(args):
+    import json
+    import os
+    from .validate import validate_file
+
+    failed = 0
+    for path in args.paths:
+        report = validate_file(path, fs=args.fs, norm_freq=args.norm_freq,
+                               norm_amp=args.norm_amp, tfft=args.tfft,
+                               asd_tol=args.asd_tol)
+        name = os.path.basename(os.path.normpath(path)) + '.qa.json'
+        outdir = args.outdir or os.path.dirname(os.path.abspath(path))
+        with open(os.path.join(outdir, name), 'w') as f:
+            json.dump(report, f, indent=1)
+        print('{}: {}'.format(path, 'ok' if report['ok'] else
+                              '; '.join(report['problems'])))
+        failed += not report['ok']
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    from .service import default_port, default_cache
+
+    parser = argparse.ArgumentParser(prog='python -m mockdata')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve = commands.add_parser(
+        'serve', help='Run a local data generation service with a shared '
+                      'result cache.')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on. Defaults to %(default)s.')
+    serve.add_argument('-p', '--port', default=default_port, type=int,
+                       help='Port to listen on. Defaults to %(default)s.')
+    serve.add_argument('-c', '--cache-dir', default=default_cache,
+                       help='Directory of the result cache. Defaults to '
+                            '%(default)s.')
+    serve.add_argument('-w', '--workers', default=2, type=int,
+                       help='Number of generation workers. Defaults to '
+                            '%(default)s.')
+    serve.add_argument('-q', '--max-queue', default=16, type=int,
+                       help='Maximum number of jobs queued or running. '
+                            'Defaults to %(default)s.')
+    serve.add_argument('-b', '--backend', default='process',
+                       choices=['process', 'thread'],
+                       help='Kind of worker pool. Defaults to %(default)s.')
+    serve.add_argument('--quiet', action='store_true',
+                       help='Do not log requests.')
+    serve.set_defaults(func=_serve)
+
+    validate = commands.add_parser(
+        'validate', help='Check saved datasets and write a JSON report '
+                         'next to each.')
+    validate.add_argument('paths', nargs='+',
+                          help='.npz, .mdc or .mat files, or directories of '
+                               '.npy files.')
+    validate.add_argument('-o', '--outdir', default=None,
+                          help='Directory for the reports. Defaults to '
+                               'that of each dataset.')
+    validate.add_argument('-f', '--fs', default=None, type=float,
+                          help='Sampling frequency, if the datasets do not '
+                               'say.')
+    validate.add_argument('--norm-freq', default=100, type=float,
+                          help='Frequency of the expected background ASD '
+                               'normalization in Hz. Defaults to '
+                               '%(default)s.')
+    validate.add_argument('--norm-amp', default=2.2e-20, type=float,
+                          help='Expected background ASD at norm-freq. '
+                               'Defaults to %(default)s.')
+    validate.add_argument('-t', '--tfft', default=4, type=float,
+                          help='Segment length in seconds. Defaults to '
+                               '%(default)s.')
+    validate.add_argument('--asd-tol', default=0.3, type=float,
+                          help='Allowed relative background ASD deviation. '
+                               'Defaults to %(default)s.')
+    validate.set_defaults(func=_validate)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,20 +2,39 @@ from __future__ import division
 import os
 import numpy as np
 import scipy.signal as sig
-from .utils import pend_sos, filter_from_npz
+from .utils import (pend_sos, filter_from_npz, apply_filter, native_rate,
+                    resample)
 
-__all__ = ['coupling_func', 'witness', 'ideal_estimate']
+__all__ = ['coupling_func', 'witness', 'ideal_estimate',
+           'ideal_estimate_pairs']
 
 
-def coupling_func(true_motion):
-    # Bilinear coupling function is just the product of the inputs
-    return np.prod(true_motion, axis=0)
+def coupling_func(true_motion, out=None):
+    '''
+    Bilinear coupling function, just the product of the inputs. Computed
+    in place in `out` if given, without stacking the inputs.
+    '''
+    out = np.multiply(true_motion[0], true_motion[1], out=out)
+    for motion in true_motion[2:]:
+        out *= motion
+    return out
+
 
+# Highest frequencies of interest of the beam spot motion and the ASC
+# control signal, which set their native rates
+_native_bands = (3, 17)
 
-def witness(sec, fs, seed=None):
+
+def witness(sec, fs, seed=None, native_fs=None):
     '''
     Signals meant to represent something like
     beam-spot motion and mirror angulary control signal.
+
+    `native_fs` gives the rates the beam spot motion and ASC control noise
+    are generated and shaped at, before being upsampled to `fs`: a pair of
+    rates, or ``'auto'`` for `utils.native_rate` of their bands. The
+    default of ``None`` works at `fs` throughout. Lower native rates make a
+    different realization for the same seed.
     '''
 
     if isinstance(seed, np.random.RandomState):
@@ -23,58 +42,66 @@ def witness(sec, fs, seed=None):
     else:
         state = np.random.RandomState(seed)
 
-    fnyq = fs / 2
-    nscale = np.sqrt(fnyq)  # To normalize unit variance to unity ASD
+    if native_fs is None:
+        # Unit variance draws for: beam spot motion, ASC control noise, and
+        # the sensing noise of the two witness channels
+        white = state.randn(4, fs * sec)
+        return _witness_from_noise(white, fs)
 
-    true_motion = np.zeros((2, fs * sec))
-    noise = np.zeros((2, fs * sec))
+    if native_fs == 'auto':
+        native_fs = [native_rate(band, fs) for band in _native_bands]
+    rates = [min(rate, fs) for rate in native_fs]
+    white = [state.randn(rate * sec) for rate in rates]
+    white.append(state.randn(2, fs * sec))
+    return _witness_from_noise(white, fs, rates)
 
-    # Random noise
-    true_motion[0, :] = state.randn(fs * sec) * nscale  # beam spot motion
-    true_motion[1, :] = state.randn(fs * sec) * nscale  # ASC control noise
+
+def _witness_from_noise(white, fs, rates=None):
+    '''
+    Shape and scale the unit variance `white` draws of `witness` into the
+    witness signals and true motions.
+
+    With `rates`, ``white`` is [beam spot draws, ASC draws, sensing noise
+    draws (2, N)], the first two at their own rates.
+    '''
+    fnyq = fs / 2
+    nscale = np.sqrt(fnyq)  # To normalize unit variance to unity ASD
 
     # Beam spot is driven around by microseism. Realistic spectrum is kind of
     # like f^-2 after microseism until a few Hz, then f^-6 from 3-10 Hz. Noise
     # floor is about 10^-7 lower than ASD at microseism, intercepting at 10 Hz.
+    if rates is None:
+        # Random noise
+        true_motion = white[:2] * nscale  # beam spot motion, ASC control
+        noise = white[2:] * nscale
 
-    # Make shaping filter for beam spot motion
-    # TODO: fix this filter shape to be like ADS error signals
-    usos1 = sig.butter(2, [0.1 / fnyq, 0.2 / fnyq],
-                       btype='bandpass',
-                       output='sos')
-    usos2 = sig.butter(4, 3 / fnyq,
-                       btype='lowpass',
-                       output='sos')
-    usos = np.concatenate([usos1, usos2], axis=0)
+        usos, rlp = _shaping_filters(fs)
 
-    # Shape beam spot motion channel
-    true_motion[0, :] = sig.sosfilt(usos, true_motion[0, :])
+        # Shape beam spot motion channel
+        true_motion[0, :] = apply_filter(usos, true_motion[0, :])
+
+        # low pass filtering on ASC control signal
+        # remove after inserting true CHARD control spectrum
+        true_motion[1, :] = apply_filter(rlp, true_motion[1, :])
+    else:
+        noise = white[2] * nscale
+        true_motion = np.empty(noise.shape)
+        for row, rate in enumerate(rates):
+            filt = _shaping_filters(rate)[row]
+            shaped = apply_filter(filt, white[row] * np.sqrt(rate / 2))
+            true_motion[row] = resample(shaped, rate, fs)
 
     # Sensing noise of beam spot witness channel
-    # Unity ASD to start
-    noise[0, :] = state.randn(fs * sec) * nscale
     # Some emperically found scaling to have some SNR over background
     noise[0, :] *= 3e-5
 
     #  y[0, :] += state.randn()  # Off-center bias
     #  n[0, :] -= state.randn()  # Cancel off-center bias, make it unknown
 
-    # Generate noise with ASC control signal shape
-    #true_motion[1, :] = make_ASC_control(sec, fs, seed=state)
-    rlp = sig.ellip(4, 3, 40, 17 / fnyq,
-                    btype='lowpass',
-                    output='sos')
-
     # We have essentially perfect knowledge of the control force
-    # Unity ASD to start
-    noise[1, :] = state.randn(fs * sec) * nscale
     # something small like DAC noise
     noise[1, :] *= 1e-13
 
-    # low pass filtering on ASC control signal
-    # remove after inserting true CHARD control spectrum
-    true_motion[1, :] = sig.sosfilt(rlp, true_motion[1, :])
-
     # Add sensing noise to witnesses
     witnesses = true_motion + noise
 
@@ -91,14 +118,54 @@ def witness(sec, fs, seed=None):
     return witnesses, true_motion
 
 
+def _shaping_filters(fs):
+    '''
+    SOS filters shaping the beam spot motion and the ASC control signal.
+    '''
+    fnyq = fs / 2
+
+    # Make shaping filter for beam spot motion
+    # TODO: fix this filter shape to be like ADS error signals
+    usos1 = sig.butter(2, [0.1 / fnyq, 0.2 / fnyq],
+                       btype='bandpass',
+                       output='sos')
+    usos2 = sig.butter(4, 3 / fnyq,
+                       btype='lowpass',
+                       output='sos')
+    usos = np.concatenate([usos1, usos2], axis=0)
+
+    # Generate noise with ASC control signal shape
+    #true_motion[1, :] = make_ASC_control(sec, fs, seed=state)
+    rlp = sig.ellip(4, 3, 40, 17 / fnyq,
+                    btype='lowpass',
+                    output='sos')
+
+    return usos, rlp
+
+
 def ideal_estimate(witnesses, fs):
     '''
     Calculate coupled noise from witness signals, to check regression potential
+
+    The angular control witness, ``witnesses[1]``, is converted to test mass
+    angle first. The witnesses themselves are left unchanged.
     '''
 
-    witnesses[1] = asc_xtal_to_angle(witnesses[1], fs)
-    estimate = coupling_func(witnesses)
+    angle = asc_xtal_to_angle(witnesses[1], fs)
+    estimate = coupling_func((witnesses[0], angle))
+
+    return estimate
 
+
+def ideal_estimate_pairs(witnesses, fs):
+    '''
+    Sum of `ideal_estimate` over witness pairs stacked as in
+    `starting_data`: all beam spot channels, then all angular controls.
+    '''
+    pairs = len(witnesses) // 2
+    estimate = 0
+    for p in range(pairs):
+        estimate += ideal_estimate((witnesses[p], witnesses[pairs + p]), fs)
     return estimate
 
 
@@ -109,8 +176,8 @@ def asc_xtal_to_angle(angular, fs):
 
     # double pendulum
     # ACK! beware of precision noise from too much low pass filtering
-    tst_angle = sig.sosfilt(pend, angular)
-    tst_angle = sig.sosfilt(pend, tst_angle)
+    tst_angle = apply_filter(pend, angular)
+    tst_angle = apply_filter(pend, tst_angle)
 
     return tst_angle
 
@@ -129,6 +196,6 @@ def make_ASC_control(sec, fs, seed=None):
                             'ASC_Models/ASC_model.npz')
     sos = filter_from_npz(zpk_file, fs)
 
-    out = sig.sosfilt(sos, white_noise)
+    out = apply_filter(sos, white_noise)
 
     return out
@@ -0,0 +1,326 @@
+from __future__ import division
+import bz2
+import json
+import lzma
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+__all__ = ['save_container', 'ChunkedContainer', 'load_container',
+           'container_ext', 'codecs']
+
+container_ext = '.mdc'
+
+_magic = b'MOCKDAT1'
+# Written after the index: its offset and length, and the magic again
+_footer = struct.Struct('<QQ8s')
+
+# Standard library compressors as (compress(bytes, level), decompress,
+# default level). All of them release the GIL, so chunks are compressed
+# in parallel by threads.
+codecs = {
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'bz2': (bz2.compress, bz2.decompress, 9),
+    'lzma': (lambda b, level: lzma.compress(b, preset=level),
+             lzma.decompress, 1),
+    'none': (lambda b, level: b, bytes, None),
+}
+
+
+def save_container(filename, data, chunk_samples=2**16, codec='zlib',
+                   level=None, shuffle=True, workers=None):
+    '''
+    Save a dictionary of arrays, as written by makeNoise.py, in a chunked
+    compressed container.
+
+    Every array is cut along its last (time) axis into chunks of
+    `chunk_samples`, separately for each row of the leading axes, so one
+    channel over a time range can be read back without touching the
+    rest (see `ChunkedContainer`). Each chunk is byte-shuffled (all first
+    bytes of its samples, then all second bytes, and so on, which groups
+    the slowly varying sign and exponent bytes of floats) and compressed
+    on its own, by a pool of threads. The chunks are followed by a JSON
+    index of where they are. Scalars, strings and lists go into the index
+    as attributes. The file is written under a temporary name and moved
+    into place when complete.
+
+    Parameters
+    ----------
+    filename : str
+        Output file. `container_ext` is appended if it has no extension.
+    data : dict
+        Arrays and attributes to save.
+    chunk_samples : int
+        Samples per chunk and row. Defaults to 2**16, 32 s at 2048 Hz.
+    codec : str
+        Compressor, one of `codecs`. Defaults to 'zlib'.
+    level : int, optional
+        Compression level. Defaults to that of the codec.
+    shuffle : bool
+        Byte-shuffle the chunks before compressing. Defaults to True.
+    workers : int, optional
+        Number of compression threads.
+
+    Returns
+    -------
+    filename : str
+        The file written.
+    '''
+    if codec not in codecs:
+        raise ValueError('Unknown codec: {}'.format(codec))
+    compress, _, default_level = codecs[codec]
+    if level is None:
+        level = default_level
+    chunk_samples = int(chunk_samples)
+    if not os.path.splitext(filename)[1]:
+        filename += container_ext
+
+    arrays = {}
+    attrs = {}
+    for name, value in data.items():
+        if isinstance(value, np.ndarray) and value.ndim > 0 and \
+                value.dtype.kind not in 'OUS':
+            arrays[name] = np.ascontiguousarray(value)
+        else:
+            attrs[name] = _to_json(value)
+
+    # Every chunk as (name, row, start, stop), in file order
+    chunks = []
+    index = {}
+    for name, arr in arrays.items():
+        rows = arr.reshape(-1, arr.shape[-1]) if arr.ndim > 1 else arr[None]
+        index[name] = {'dtype': _dtype_to_json(arr.dtype),
+                       'shape': list(arr.shape), 'chunks': []}
+        for row in range(rows.shape[0]):
+            for start in range(0, max(arr.shape[-1], 1), chunk_samples):
+                chunks.append((name, rows[row],
+                               start, min(start + chunk_samples,
+                                          arr.shape[-1])))
+
+    def encode(chunk):
+        _, row, start, stop = chunk
+        raw = _shuffle(row[start:stop]) if shuffle else \
+            row[start:stop].tobytes()
+        return compress(raw, level) if level is not None else raw
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f, ThreadPoolExecutor(workers) as pool:
+        f.write(_magic)
+        offset = len(_magic)
+        for chunk, blob in zip(chunks, pool.map(encode, chunks)):
+            f.write(blob)
+            index[chunk[0]]['chunks'].append([offset, len(blob)])
+            offset += len(blob)
+
+        blob = json.dumps({'codec': codec, 'shuffle': bool(shuffle),
+                           'chunk_samples': chunk_samples, 'arrays': index,
+                           'attrs': attrs}).encode('utf-8')
+        f.write(blob)
+        f.write(_footer.pack(offset, len(blob), _magic))
+    os.replace(tmp, filename)
+    return filename
+
+
+class ChunkedContainer(object):
+    '''
+    Reader of a file written by `save_container`.
+
+    Arrays are read whole with ``container[name]``, or in part with
+    `read` and `read_time`, which only decompress the chunks overlapping
+    the requested rows and time range. Chunks are decompressed by a pool
+    of threads straight into the output array. The file is memory-mapped,
+    so the reader is cheap to open and can be shared between threads.
+    Use it as a context manager, or `close` it.
+
+    Parameters
+    ----------
+    filename : str
+        Container file.
+    workers : int, optional
+        Number of decompression threads.
+
+    Attributes
+    ----------
+    attrs : dict
+        The non-array entries saved, such as 'fs' and 't0'.
+    '''
+    def __init__(self, filename, workers=None):
+        self.filename = filename
+        self._pool = None
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(_magic) + _footer.size or \
+                self._map[:len(_magic)] != _magic:
+            self.close()
+            raise ValueError('{} is not a chunked container'.format(filename))
+        offset, length, magic = _footer.unpack(self._map[-_footer.size:])
+        if magic != _magic:
+            self.close()
+            raise ValueError('{} is truncated'.format(filename))
+        index = json.loads(self._map[offset:offset + length].decode('utf-8'))
+
+        self.codec = index['codec']
+        self.shuffle = index['shuffle']
+        self.chunk_samples = index['chunk_samples']
+        self.attrs = index['attrs']
+        self._arrays = index['arrays']
+        self._decompress = codecs[self.codec][1]
+        self._pool = ThreadPoolExecutor(workers)
+
+    def keys(self):
+        return list(self._arrays) + list(self.attrs)
+
+    def __contains__(self, name):
+        return name in self._arrays or name in self.attrs
+
+    def __getitem__(self, name):
+        if name in self.attrs:
+            return self.attrs[name]
+        return self.read(name)
+
+    def shape(self, name):
+        '''
+        Shape of a saved array.
+        '''
+        return tuple(self._arrays[name]['shape'])
+
+    def read(self, name, start=0, stop=None, rows=None):
+        '''
+        Samples `start` to `stop` of an array, for all rows of its leading
+        axes or only `rows`.
+
+        `rows` indexes the leading axes flattened to one, e.g. the channel
+        of a (channel, time) witness array. An int gives a 1-D result,
+        a sequence or slice a 2-D one. Without `rows` the result keeps the
+        saved shape, with the last axis cut to the time range.
+        '''
+        entry = self._arrays[name]
+        shape = tuple(entry['shape'])
+        dtype = _dtype_from_json(entry['dtype'])
+        N = shape[-1]
+        start, stop, _ = slice(start, stop).indices(N)
+        stop = max(start, stop)
+        n_rows = int(np.prod(shape[:-1])) if len(shape) > 1 else 1
+        per_row = max(-(-N // self.chunk_samples), 1)
+
+        if rows is None:
+            selected = range(n_rows)
+        elif isinstance(rows, slice):
+            selected = range(*rows.indices(n_rows))
+        else:
+            selected = np.atleast_1d(rows)
+            if np.any((selected < -n_rows) | (selected >= n_rows)):
+                raise IndexError('Rows out of range for {} rows'.format(
+                    n_rows))
+            selected = selected % n_rows
+
+        out = np.empty((len(selected), stop - start), dtype=dtype)
+        first = start // self.chunk_samples
+        last = -(-stop // self.chunk_samples)
+        tasks = [(ii, row, block) for ii, row in enumerate(selected)
+                 for block in range(first, last)]
+
+        def decode(task):
+            ii, row, block = task
+            offset, length = entry['chunks'][int(row) * per_row + block]
+            lo = block * self.chunk_samples
+            hi = min(lo + self.chunk_samples, N)
+            raw = self._decompress(self._map[offset:offset + length])
+            if self.shuffle:
+                chunk = _unshuffle(raw, dtype, hi - lo)
+            else:
+                chunk = np.frombuffer(raw, dtype=dtype)
+            a, b = max(lo, start), min(hi, stop)
+            out[ii, a - start:b - start] = chunk[a - lo:b - lo]
+
+        list(self._pool.map(decode, tasks))
+
+        if rows is None:
+            return out.reshape(shape[:-1] + (stop - start,))
+        if np.ndim(rows) == 0 and not isinstance(rows, slice):
+            return out[0]
+        return out
+
+    def read_time(self, name, t_start, t_stop, rows=None, fs=None):
+        '''
+        `read` a time range in seconds, measured from the saved 't0'
+        (0 if there is none) at the saved 'fs', unless `fs` is given.
+        '''
+        if fs is None:
+            if 'fs' not in self.attrs:
+                raise ValueError('No sampling frequency in {}'.format(
+                    self.filename))
+            fs = self.attrs['fs']
+        t0 = self.attrs.get('t0', 0)
+        start = int(round((t_start - t0) * fs))
+        stop = int(round((t_stop - t0) * fs))
+        return self.read(name, max(start, 0), max(stop, 0), rows=rows)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return 'ChunkedContainer({!r}, arrays={})'.format(
+            self.filename, sorted(self._arrays))
+
+
+def load_container(filename, workers=None):
+    '''
+    Read all arrays and attributes of a container into a dictionary.
+    '''
+    with ChunkedContainer(filename, workers=workers) as container:
+        return {name: container[name] for name in container.keys()}
+
+
+def _shuffle(x):
+    '''
+    Bytes of `x` grouped by their position within the samples.
+    '''
+    raw = np.ascontiguousarray(x).view(np.uint8)
+    return raw.reshape(-1, x.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(raw, dtype, n):
+    shuffled = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, n)
+    return shuffled.T.copy().view(dtype).reshape(n)
+
+
+def _dtype_to_json(dtype):
+    if dtype.fields is None:
+        return dtype.str
+    return dtype.descr
+
+
+def _dtype_from_json(descr):
+    if isinstance(descr, str):
+        return np.dtype(descr)
+    return np.dtype([tuple(field) for field in descr])
+
+
+def _to_json(value):
+    '''
+    JSON friendly version of an attribute.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    return value
@@ -0,0 +1,205 @@
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from .mock_bg import compose_background, mains_lines, _component_asd
+from .sinusoids import SinusoidBank
+from .utils import resample
+
+__all__ = ['build_frame', 'save_frame', 'read_channel_list',
+           'channel_templates']
+
+
+class _Shape(object):
+    '''
+    ASD callable in counts/sqrt(Hz): a floor of `amp`, rising as
+    ``f**-slope`` below `knee`, plus an optional microseism-like peak
+    ``(f0, q, height)`` and a 4th order roll-off above `lowpass`. A class
+    rather than a closure so templates can be sent to worker processes.
+    '''
+    def __init__(self, amp, knee=None, slope=1, peak=None, lowpass=None):
+        self.amp = amp
+        self.knee = knee
+        self.slope = slope
+        self.peak = peak
+        self.lowpass = lowpass
+
+    def __call__(self, freqs):
+        f = np.maximum(freqs, 1e-2)
+        psd = np.ones(f.shape)
+        if self.knee is not None:
+            psd += (self.knee / f)**(2 * self.slope)
+        if self.peak is not None:
+            f0, q, height = self.peak
+            psd += height**2 / (1 + ((f - f0) * 2 * q / f0)**2)
+        if self.lowpass is not None:
+            psd /= 1 + (f / self.lowpass)**8
+        return self.amp * np.sqrt(psd)
+
+
+# Spectral template per channel name prefix (without the IFO), first match
+# wins. 'rate' is the native sample rate; 'lines' is True for the mains
+# lines, or a list of calibration line frequencies for pure line channels.
+channel_templates = [
+    ('OAF-CAL_DARM', {'asd': {}, 'rate': 4096, 'lines': True}),
+    ('OMC-DCPD', {'asd': {'norm_amp': 1e-6}, 'rate': 4096, 'lines': True,
+                  'dc': 20.0}),
+    ('CAL-', {'lines': [17.1, 35.9, 331.9, 1083.7], 'rate': 4096}),
+    ('SUS-ETMY_L3_CAL_LINE', {'lines': [35.9], 'rate': 4096}),
+    ('ASC-', {'asd': _Shape(1e-3, peak=(0.15, 2, 1e3), lowpass=17),
+              'rate': 512}),
+    ('LSC-', {'asd': _Shape(1e-2, knee=20, slope=2), 'rate': 2048}),
+    ('PEM-CS_ACC', {'asd': _Shape(1e-4, knee=5, slope=1, lowpass=900),
+                    'rate': 2048, 'lines': True}),
+    ('PEM-CS_MIC', {'asd': _Shape(1e-3, knee=30, slope=1), 'rate': 2048,
+                    'lines': True}),
+    ('HPI-', {'asd': _Shape(1e-2, knee=1, slope=2, peak=(0.15, 2, 1e3),
+                            lowpass=50), 'rate': 256}),
+    ('', {'asd': _Shape(1.0), 'rate': 256}),
+]
+
+
+def read_channel_list(filename):
+    '''
+    Channel names of a channel list file, one per line as in
+    ChanList_darm.txt.
+    '''
+    with open(filename, 'r') as f:
+        return f.read().split()
+
+
+def build_frame(channels, sec, fs=256, ifo='H1', seed=None, templates=None,
+                native=True, workers=None, backend='process'):
+    '''
+    Generate mock data for a list of real channel names, in the layout
+    getDARMbilinearData.py saves.
+
+    Each channel gets the spectral template of the first prefix in
+    `channel_templates` that its name starts with: a noise ASD (a bucket
+    shape dict or an ASD callable, as for `compose_background`), mains or
+    calibration lines, and a DC offset. Channels are generated at their
+    template's native rate and resampled to `fs` with a polyphase filter,
+    much like the decimation of real data. They are made in parallel,
+    each from its own random stream, so the result depends on `seed` but
+    not on `workers` or `backend`. Only the resampled channels come back
+    from the workers. Channels are independent realizations; nothing
+    couples between them.
+
+    Parameters
+    ----------
+    channels : str or list of str
+        Channel names, or a channel list file to read them from.
+    sec : int
+        Length in seconds.
+    fs : int
+        Output sample rate in Hz. Defaults to 256 Hz, the rate
+        getDARMbilinearData.py downsamples to.
+    ifo : str, optional
+        Detector prefix added to the names, as in 'H1:'. ``None`` leaves
+        the names as they are.
+    seed : int or np.random.RandomState instance, optional
+        Seed of the channel streams.
+    templates : list of (str, dict), optional
+        Extra (prefix, template) pairs, tried before `channel_templates`.
+    native : bool
+        Generate at the native rates. If False, everything is generated
+        at `fs` directly, which is faster but skips the resampling.
+        Defaults to True.
+    workers : int, optional
+        Number of parallel workers. Defaults to the number of CPUs.
+    backend : {'process', 'thread'}
+        Kind of worker pool. Defaults to 'process'; templates must then
+        be picklable.
+
+    Returns
+    -------
+    frame : dict
+        'data', an array of shape (channels, sec*fs), 'fsample', and
+        'chans', the channel names.
+    '''
+    if isinstance(channels, str):
+        channels = read_channel_list(channels)
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+    base_seed = state.randint(2**31 - 1)
+    templates = list(templates or []) + channel_templates
+
+    N = int(sec * fs)
+    data = np.empty((len(channels), N))
+    chosen = [_template(name, templates) for name in channels]
+    states = [np.random.RandomState([base_seed, ii])
+              for ii in range(len(channels))]
+
+    if backend == 'process':
+        pool = ProcessPoolExecutor(workers)
+    else:
+        pool = ThreadPoolExecutor(workers)
+    with pool:
+        rows = pool.map(_render_channel, chosen, [sec] * len(channels),
+                        [fs] * len(channels), states,
+                        [native] * len(channels))
+        for ii, row in enumerate(rows):
+            data[ii] = row
+
+    if ifo is not None:
+        channels = ['{}:{}'.format(ifo, name) for name in channels]
+    return {'data': data, 'fsample': fs, 'chans': list(channels)}
+
+
+def save_frame(filename, frame):
+    '''
+    Save a frame from `build_frame` as a compressed .mat file, like
+    getDARMbilinearData.py.
+    '''
+    from scipy.io import savemat
+    savemat(filename, mdict=frame, do_compression=True)
+
+
+def _template(name, templates):
+    for prefix, template in templates:
+        if name.startswith(prefix):
+            return template
+    raise ValueError('No template for channel {}'.format(name))
+
+
+def _render_channel(template, sec, fs, state, native=True):
+    '''
+    One channel of `sec` seconds at `fs` from its template.
+    '''
+    rate = template.get('rate', fs) if native else fs
+    lines = template.get('lines', False)
+
+    if 'asd' in template:
+        if lines is True:
+            catalog = mains_lines()
+            catalog.amp *= 10 * _asd_at(template['asd'], 60)
+            catalog = catalog[catalog.freq < 0.8 * (rate / 2)]
+        else:
+            catalog = []
+        x = compose_background(sec, rate, components=[template['asd']],
+                               catalog=catalog, seed=state)
+        x = resample(x, rate, fs)
+    else:
+        x = np.zeros(int(sec * fs))
+
+    if lines and lines is not True:
+        # Calibration lines are exact sinusoids, made at the output rate;
+        # the ones decimation would remove are left out
+        freqs = np.asarray(lines, dtype=float)
+        freqs = freqs[freqs < 0.8 * (fs / 2)]
+        SinusoidBank(freqs, fs, amps=np.ones(freqs.size),
+                     phases=state.uniform(-np.pi, np.pi, size=freqs.size)
+                     ).render(x, add=True)
+
+    x += template.get('dc', 0)
+    return x
+
+
+def _asd_at(asd, freq):
+    '''
+    Value of a template ASD at one frequency.
+    '''
+    return _component_asd(np.array([float(freq)]), asd)[0]
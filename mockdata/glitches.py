@@ -0,0 +1,147 @@
+from __future__ import division
+import numpy as np
+
+__all__ = ['glitch_table', 'random_glitches', 'inject_glitches']
+
+glitch_dtype = np.dtype([('time', float),
+                         ('f0', float),
+                         ('Q', float),
+                         ('amp', float),
+                         ('phase', float)])
+
+# Sine-Gaussians are cut off this many e-folding times from their center
+_tau_cut = 4
+# Maximum number of samples rendered at once
+_max_samples = 2**22
+
+
+def glitch_table(time, f0, Q, amp, phase=0):
+    '''
+    Make a table of sine-Gaussian transients to inject with
+    `inject_glitches`.
+
+    All arguments are broadcast against each other. Each transient is
+
+        amp * exp(-(t - time)**2 / tau**2) * sin(2 pi f0 (t - time) + phase)
+
+    with ``tau = Q / (sqrt(2) pi f0)``. Blip glitches are well described
+    by low Q (2-3) sine-Gaussians.
+
+    Parameters
+    ----------
+    time : array_like
+        Central times in seconds.
+    f0 : array_like
+        Central frequencies in Hz.
+    Q : array_like
+        Quality factors.
+    amp : array_like
+        Peak amplitudes of the envelopes.
+    phase : array_like
+        Carrier phases in radians. Defaults to 0.
+
+    Returns
+    -------
+    table : recarray
+        Record array with fields 'time', 'f0', 'Q', 'amp' and 'phase'.
+    '''
+    arrays = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=float))
+                                   for a in (time, f0, Q, amp, phase)])
+    table = np.zeros(arrays[0].shape, dtype=glitch_dtype).view(np.recarray)
+    for name, arr in zip(glitch_dtype.names, arrays):
+        table[name] = arr
+
+    if np.any(table.f0 <= 0) or np.any(table.Q <= 0):
+        raise ValueError('Glitch f0 and Q must be >0')
+
+    return table
+
+
+def random_glitches(n, sec, f0=(30, 500), Q=(2, 30), amp=(1e-21, 1e-19),
+                    seed=None):
+    '''
+    Draw a table of `n` transients spread uniformly over `sec` seconds.
+
+    `f0`, `Q` and `amp` are (low, high) ranges that are sampled
+    log-uniformly. Phases are uniform.
+    '''
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    def log_uniform(bounds):
+        return np.exp(state.uniform(np.log(bounds[0]), np.log(bounds[1]),
+                                    size=n))
+
+    return glitch_table(state.uniform(0, sec, size=n),
+                        log_uniform(f0),
+                        log_uniform(Q),
+                        log_uniform(amp),
+                        state.uniform(-np.pi, np.pi, size=n))
+
+
+def inject_glitches(data, fs, table, aux=None, t0=0):
+    '''
+    Add the transients in a table to a time series, in place.
+
+    Transients are sorted by duration and rendered in batches on a common
+    local time grid, so thousands of them cost a handful of vectorized
+    operations, and only the samples each one covers are touched.
+
+    Parameters
+    ----------
+    data : ndarray, shape (N,)
+        Time series to inject into, e.g. the target of `starting_data`.
+    fs : float
+        Sampling frequency of `data` in Hz.
+    table : recarray
+        Transients to inject, as made by `glitch_table`.
+    aux : dict, optional
+        If given, the injection table is stored in ``aux['glitches']``.
+    t0 : float
+        Time of the first sample of `data`. Defaults to 0.
+
+    Returns
+    -------
+    data : ndarray
+        The input array, with the transients added.
+    '''
+    N = data.size
+    tau = table.Q / (np.sqrt(2) * np.pi * table.f0)
+    half = np.ceil(_tau_cut * tau * fs).astype(int)
+    center = np.round((table.time - t0) * fs).astype(int)
+
+    # Skip transients that don't overlap the data at all
+    hit = (center + half >= 0) & (center - half < N)
+    order = np.argsort(half[hit])
+    idx = np.flatnonzero(hit)[order]
+
+    start = 0
+    while start < idx.size:
+        # Grow the batch while the (glitches x local samples) grid fits
+        stop = start + 1
+        while (stop < idx.size and
+               (stop + 1 - start) * (2 * half[idx[stop]] + 1) <= _max_samples):
+            stop += 1
+        batch = idx[start:stop]
+        width = 2 * half[batch[-1]] + 1
+
+        offsets = np.arange(width) - half[batch[-1]]
+        samples = center[batch, np.newaxis] + offsets
+        valid = ((np.abs(offsets) <= half[batch, np.newaxis]) &
+                 (samples >= 0) & (samples < N))
+
+        dt = samples / fs + t0 - table.time[batch, np.newaxis]
+        vals = table.amp[batch, np.newaxis] * \
+            np.exp(-(dt / tau[batch, np.newaxis])**2) * \
+            np.sin(2 * np.pi * table.f0[batch, np.newaxis] * dt +
+                   table.phase[batch, np.newaxis])
+
+        np.add.at(data, samples[valid], vals[valid])
+        start = stop
+
+    if aux is not None:
+        aux['glitches'] = table
+
+    return data
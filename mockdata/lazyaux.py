@@ -0,0 +1,88 @@
+from __future__ import division
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+__all__ = ['LazyAux']
+
+
+class LazyAux(MutableMapping):
+    '''
+    Dict of auxiliary outputs whose expensive entries are only computed
+    when first read.
+
+    Entries are either set like in a dict, or deferred with `defer`, which
+    stores a function that makes the value from intermediates it keeps a
+    reference to. The function is called on first access, its result
+    stored, and the function (and with it the intermediates) dropped.
+    Anything that reads every entry, such as ``dict(aux)`` or
+    ``savemat(..., aux)``, evaluates them all.
+    '''
+    def __init__(self, *args, **kwargs):
+        self._values = {}
+        self._pending = {}
+        self.update(*args, **kwargs)
+
+    def defer(self, key, func):
+        '''
+        Make ``self[key]`` evaluate to ``func()`` on first access.
+        '''
+        self._values.pop(key, None)
+        self._pending[key] = func
+
+    def is_evaluated(self, key):
+        '''
+        Whether the entry `key` holds a computed value.
+        '''
+        if key not in self:
+            raise KeyError(key)
+        return key in self._values
+
+    @property
+    def pending(self):
+        '''
+        Keys of the entries that have not been computed yet.
+        '''
+        return list(self._pending)
+
+    def evaluate(self):
+        '''
+        Compute all pending entries. Returns the mapping.
+        '''
+        for key in self.pending:
+            self[key]
+        return self
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._values[key] = self._pending.pop(key)()
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key in self._pending:
+            del self._pending[key]
+        else:
+            del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._pending
+
+    def __iter__(self):
+        for key in list(self._values):
+            yield key
+        for key in list(self._pending):
+            yield key
+
+    def __len__(self):
+        return len(self._values) + len(self._pending)
+
+    def __repr__(self):
+        items = ['{!r}: {!r}'.format(key, value)
+                 for key, value in self._values.items()]
+        items += ['{!r}: <pending>'.format(key) for key in self._pending]
+        return 'LazyAux({{{}}})'.format(', '.join(items))
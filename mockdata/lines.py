@@ -0,0 +1,264 @@
+from __future__ import division
+import numpy as np
+import scipy.signal as sig
+from scipy.fft import next_fast_len
+
+from .utils import zpk_bilinear_bank
+from .sinusoids import SinusoidBank
+
+__all__ = ['line_catalog', 'add_lines']
+
+line_dtype = np.dtype([('freq', float),
+                       ('width', float),
+                       ('amp', float),
+                       ('wander', float)])
+
+# Broadened lines are rendered out to this many widths from the center
+# in the frequency domain, renormalized to carry the full line power
+_support_widths = 20
+# Maximum number of frequency bins rendered at once
+_max_bins = 2**22
+
+
+def line_catalog(freq, width=0, amp=1, wander=0):
+    '''
+    Make a catalog of spectral lines to inject with `add_lines`.
+
+    All arguments are broadcast against each other.
+
+    Parameters
+    ----------
+    freq : array_like
+        Center frequencies of the lines in Hz.
+    width : array_like
+        Full width at half maximum of each line in Hz. A width of zero
+        makes a coherent sinusoid, anything else a Lorentzian noise line.
+        Defaults to 0.
+    amp : array_like
+        Peak amplitude of each line. Broadened lines carry the same power
+        as a sinusoid of this amplitude. Defaults to 1.
+    wander : array_like
+        RMS excursion in Hz of the slowly drifting center frequency of the
+        coherent lines. Defaults to 0.
+
+    Returns
+    -------
+    catalog : recarray
+        Record array with fields 'freq', 'width', 'amp' and 'wander'.
+    '''
+    arrays = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=float))
+                                   for a in (freq, width, amp, wander)])
+    catalog = np.zeros(arrays[0].shape, dtype=line_dtype).view(np.recarray)
+    for name, arr in zip(line_dtype.names, arrays):
+        catalog[name] = arr
+
+    if np.any(catalog.width < 0) or np.any(catalog.wander < 0):
+        raise ValueError('Line widths and wander must be >=0')
+
+    return catalog
+
+
+def add_lines(data, fs, catalog, seed=None, method='fft', wander_time=10):
+    '''
+    Add the lines in a catalog to a time series, in place.
+
+    Coherent lines (zero width) are synthesized directly in the time domain.
+    Broadened lines are either rendered locally around each line in the
+    frequency domain followed by a single inverse FFT (``method='fft'``),
+    or made by driving a parallel bank of second-order resonators with
+    independent white noise (``method='sos'``). Both scale linearly with
+    the number of lines. Lines above 80% of Nyquist are skipped.
+
+    Parameters
+    ----------
+    data : ndarray, shape (N,)
+        Time series the lines are added to.
+    fs : float
+        Sampling frequency of `data` in Hz.
+    catalog : recarray
+        Lines to inject, as made by `line_catalog`.
+    seed : int or np.random.RandomState instance, optional
+        Seed or `RandomState` used for line phases and noise.
+    method : {'fft', 'sos'}
+        How to render the broadened lines. Defaults to 'fft'.
+    wander_time : float
+        Correlation time in seconds of the center frequency drift of
+        wandering coherent lines. Defaults to 10 s.
+
+    Returns
+    -------
+    data : ndarray
+        The input array, with the lines added.
+    '''
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    if method not in ('fft', 'sos'):
+        raise ValueError('Unknown line rendering method: {}'.format(method))
+
+    coherent = catalog[catalog.width == 0]
+    broad = catalog[catalog.width > 0]
+
+    phases = state.uniform(-np.pi, np.pi, size=len(coherent))
+    keep = coherent.freq < 0.8 * (fs / 2)  # Sub-nyquist, ok to add line
+    if np.any(keep):
+        _add_sinusoids(data, fs, coherent[keep], phases[keep], state,
+                       wander_time)
+
+    broad = broad[broad.freq < 0.8 * (fs / 2)]
+    if broad.size == 0:
+        pass
+    elif method == 'fft':
+        _add_broad_fft(data, fs, broad, state)
+    else:
+        _add_broad_sos(data, fs, broad, state)
+
+    return data
+
+
+def _add_sinusoids(data, fs, lines, phases, state, wander_time):
+    bank = SinusoidBank(lines.freq, fs, amps=lines.amp, phases=phases)
+    if not np.any(lines.wander > 0):
+        bank.render(data, add=True)
+        return
+
+    # Frequency drift as a smooth AR(1) process on knots spaced a tenth of
+    # the correlation time apart, held constant over each synthesis block
+    N = data.size
+    dt_knot = wander_time / 10
+    n_knot = int(np.ceil(N / fs / dt_knot)) + 2
+    rho = np.exp(-dt_knot / wander_time)
+    drive = state.randn(lines.size, n_knot) * np.sqrt(1 - rho**2)
+    drive[:, 0] = state.randn(lines.size)
+    drift = sig.lfilter([1], [1, -rho], drive, axis=1)
+    drift *= lines.wander[:, np.newaxis]
+    t_knot = np.arange(n_knot) * dt_knot
+
+    for start in range(0, N, bank.block):
+        stop = min(start + bank.block, N)
+        t_mid = (start + stop) / 2 / fs
+        offset = [np.interp(t_mid, t_knot, d) for d in drift]
+        bank.render(data[start:stop], add=True, freq_offset=offset)
+
+
+def _add_broad_fft(data, fs, lines, state):
+    N = data.size
+    Nfft = next_fast_len(N, real=True)
+    rfft_data = np.zeros(Nfft // 2 + 1, dtype=np.complex128)
+    _broad_bins(rfft_data, Nfft, fs, lines, state)
+    data += np.fft.irfft(rfft_data, n=Nfft)[:N]
+
+
+def _render_rfft(rfft_data, Nfft, fs, catalog, state):
+    '''
+    Add the lines of a catalog to the one-sided spectrum of an `Nfft`-point
+    real series, in place.
+
+    Broadened lines and the coherent lines that fall exactly on an FFT bin
+    are rendered into the spectrum. Returns the other coherent lines and
+    their phases, which have to be added in the time domain with
+    `_add_sinusoids`. Random numbers are drawn in the same order as
+    `add_lines`.
+    '''
+    coherent = catalog[catalog.width == 0]
+    broad = catalog[catalog.width > 0]
+
+    phases = state.uniform(-np.pi, np.pi, size=len(coherent))
+    keep = coherent.freq < 0.8 * (fs / 2)
+    coherent = coherent[keep]
+    phases = phases[keep]
+
+    # A line on bin k is periodic over the transform length, and
+    # amp sin(w t + phase) maps to amp Nfft / 2 exp(1j (phase - pi / 2))
+    bins = coherent.freq * Nfft / fs
+    on_bin = ((np.abs(bins - np.round(bins)) < 1e-9 * np.maximum(bins, 1)) &
+              (coherent.wander == 0) & (bins >= 0.5))
+    k = np.round(bins[on_bin]).astype(int)
+    np.add.at(rfft_data, k, coherent.amp[on_bin] * Nfft / 2 *
+              np.exp(1j * (phases[on_bin] - np.pi / 2)))
+
+    broad = broad[broad.freq < 0.8 * (fs / 2)]
+    if broad.size:
+        _broad_bins(rfft_data, Nfft, fs, broad, state)
+
+    return coherent[~on_bin], phases[~on_bin]
+
+
+def _broad_bins(rfft_data, Nfft, fs, lines, state):
+    '''
+    Add broadened lines to the one-sided spectrum of an `Nfft`-point real
+    series, in place.
+    '''
+    df = fs / Nfft
+
+    # Bins within the support of each line
+    half = np.maximum(np.ceil(_support_widths * lines.width / df), 2)
+    lo = np.maximum(np.floor(lines.freq / df) - half, 1).astype(int)
+    hi = np.minimum(np.ceil(lines.freq / df) + half,
+                    Nfft // 2 - 1).astype(int)
+    counts = hi - lo + 1
+
+    # Fraction of the Lorentzian power inside the support
+    captured = (np.arctan(2 * (hi * df - lines.freq) / lines.width) -
+                np.arctan(2 * (lo * df - lines.freq) / lines.width)) / np.pi
+
+    for batch in _batches(counts, _max_bins):
+        owner = np.repeat(batch, counts[batch])
+        offsets = np.cumsum(counts[batch]) - counts[batch]
+        bins = np.arange(owner.size) - np.repeat(offsets, counts[batch])
+        bins += lo[owner]
+
+        # One-sided Lorentzian PSD with unit integral, scaled to the line
+        # power
+        ff = bins * df
+        width = lines.width[owner]
+        power = lines.amp[owner]**2 / 2 / captured[owner]
+        psd = power * (2 / (np.pi * width)) / \
+            (1 + (2 * (ff - lines.freq[owner]) / width)**2)
+
+        # Complex Gaussian bins with E|X|^2 = psd * fs * Nfft / 2
+        bin_amp = np.sqrt(psd * fs * Nfft / 4)
+        vals = bin_amp * (state.randn(bins.size) +
+                          1j * state.randn(bins.size))
+        np.add.at(rfft_data, bins, vals)
+
+
+def _batches(counts, max_total):
+    '''
+    Split indices into consecutive groups whose counts sum to at most
+    `max_total` (or a single index, if that alone is larger).
+    '''
+    start = 0
+    total = 0
+    for ii, count in enumerate(counts):
+        if total + count > max_total and ii > start:
+            yield np.arange(start, ii)
+            start = ii
+            total = 0
+        total += count
+    if start < len(counts):
+        yield np.arange(start, len(counts))
+
+
+def _add_broad_sos(data, fs, lines, state):
+    # Resonator bw s / (s^2 + bw s + w0^2) with unity peak gain, whose power
+    # response integrates to pi/2 times the width. Both band edges are
+    # prewarped so the digital line keeps its width.
+    f_lo = np.maximum(lines.freq - lines.width / 2, lines.freq / 2)
+    f_hi = lines.freq + lines.width / 2
+    w_lo = 2 * fs * np.tan(np.pi * f_lo / fs)
+    w_hi = 2 * fs * np.tan(np.pi * f_hi / fs)
+    w0 = np.sqrt(w_lo * w_hi)
+    bw = w_hi - w_lo
+
+    root = np.sqrt(w0**2 - bw**2 / 4 + 0j)
+    poles = np.stack([-bw / 2 + 1j * root, -bw / 2 - 1j * root], axis=1)
+    zeros = np.zeros((lines.size, 1))
+    bank = zpk_bilinear_bank(zeros, poles, bw, fs)
+
+    # White noise scaled so that each line has variance amp**2 / 2
+    drive_amp = lines.amp * np.sqrt(fs / (2 * np.pi * lines.width))
+    for sos, scale in zip(bank, drive_amp):
+        data += sig.sosfilt(sos, scale * state.randn(data.size))
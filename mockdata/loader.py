@@ -0,0 +1,164 @@
+from __future__ import division
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from .mock_noise import starting_data, sec_d, fs_d
+
+__all__ = ['MinibatchLoader']
+
+
+class MinibatchLoader(object):
+    '''
+    Iterator over minibatches of windows cut from mock data generated on
+    demand.
+
+    Each realization of `starting_data` is cut into
+    `windows_per_realization` windows at random offsets, which are handed
+    out as consecutive minibatches. Realizations are generated ahead of
+    time by a pool of workers, with at most `prefetch` of them in flight.
+    Realization ``r`` is always generated from the seed ``[seed, r]``, so
+    batch ``i`` is the same no matter the number of workers or backend.
+
+    Batches are plain arrays, so the loader can feed any training framework.
+
+    Parameters
+    ----------
+    model : string
+        Noise model passed to `starting_data`. Defaults to 'scatter'.
+    window : int
+        Length of each window in samples.
+    batch_size : int
+        Windows per minibatch. Defaults to 32.
+    windows_per_realization : int, optional
+        Windows cut from each generated realization. Must be a multiple of
+        `batch_size`. Defaults to `batch_size`.
+    n_batches : int, optional
+        Number of batches to yield. If ``None``, iterate forever.
+    sec, fs : int
+        Length in seconds and sampling frequency of each realization.
+    seed : int, optional
+        Base seed. If ``None``, one is drawn at random on construction.
+    parse_str : list of str
+        Model keywords, as for `starting_data`.
+    workers : int
+        Number of worker threads or processes. Defaults to 2.
+    prefetch : int
+        Maximum number of realizations queued ahead of the consumer.
+        Defaults to 2 * `workers`.
+    backend : {'thread', 'process'}
+        Kind of worker pool. Defaults to 'thread'.
+    '''
+    def __init__(self, model='scatter', window=fs_d, batch_size=32,
+                 windows_per_realization=None, n_batches=None, sec=sec_d,
+                 fs=fs_d, seed=None, parse_str='', workers=2, prefetch=None,
+                 backend='thread'):
+        if windows_per_realization is None:
+            windows_per_realization = batch_size
+        if windows_per_realization % batch_size != 0:
+            raise ValueError('windows_per_realization must be a multiple of '
+                             'batch_size')
+        if window > sec * fs:
+            raise ValueError('Window is longer than a realization')
+        if backend not in ('thread', 'process'):
+            raise ValueError('Unknown backend: {}'.format(backend))
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+
+        self.model = model
+        self.window = int(window)
+        self.batch_size = batch_size
+        self.windows_per_realization = windows_per_realization
+        self.n_batches = n_batches
+        self.sec = sec
+        self.fs = fs
+        self.seed = seed
+        self.parse_str = parse_str
+        self.workers = workers
+        self.prefetch = prefetch if prefetch is not None else 2 * workers
+        self.backend = backend
+
+    @property
+    def batches_per_realization(self):
+        return self.windows_per_realization // self.batch_size
+
+    def __len__(self):
+        if self.n_batches is None:
+            raise TypeError('Infinite loader has no length')
+        return self.n_batches
+
+    def batch(self, index):
+        '''
+        Generate minibatch `index` directly, without the worker pool.
+        '''
+        k = self.batches_per_realization
+        return self._realization(index // k)[index % k]
+
+    def _realization(self, r):
+        return _realization_batches(self.model, self.sec, self.fs, self.seed,
+                                    r, self.parse_str, self.window,
+                                    self.batch_size,
+                                    self.windows_per_realization)
+
+    def __iter__(self):
+        k = self.batches_per_realization
+        if self.n_batches is None:
+            n_real = None
+        else:
+            n_real = -(-self.n_batches // k)
+
+        if self.backend == 'thread':
+            pool = ThreadPoolExecutor(self.workers)
+        else:
+            pool = ProcessPoolExecutor(self.workers)
+
+        pending = deque()
+        next_r = 0
+        yielded = 0
+        try:
+            while True:
+                while (len(pending) < self.prefetch and
+                       (n_real is None or next_r < n_real)):
+                    pending.append(pool.submit(
+                        _realization_batches, self.model, self.sec, self.fs,
+                        self.seed, next_r, self.parse_str, self.window,
+                        self.batch_size, self.windows_per_realization))
+                    next_r += 1
+                if not pending:
+                    return
+
+                for batch in pending.popleft().result():
+                    if self.n_batches is not None and \
+                            yielded >= self.n_batches:
+                        return
+                    yield batch
+                    yielded += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+def _realization_batches(model, sec, fs, seed, r, parse_str, window,
+                         batch_size, n_windows):
+    '''
+    Generate realization `r` and cut it into minibatches of
+    (witnesses, target) windows.
+    '''
+    _, _, target, wits, _ = starting_data(sec=sec, fs=fs, model=model,
+                                          seed=np.random.RandomState([seed, r]),
+                                          parse_str=parse_str,
+                                          retain_aux=False)
+    wits = np.atleast_2d(wits)
+
+    state = np.random.RandomState([seed, r, 1])
+    starts = state.randint(0, target.size - window + 1, size=n_windows)
+    idx = starts[:, np.newaxis] + np.arange(window)
+
+    batches = []
+    for ii in range(0, n_windows, batch_size):
+        sel = idx[ii:ii + batch_size]
+        batches.append((np.ascontiguousarray(wits[:, sel].transpose(1, 0, 2)),
+                        target[sel]))
+    return batches
@@ -1,9 +1,18 @@
 from __future__ import division
 import numpy as np
 import scipy.signal as sig
+from scipy.fft import next_fast_len
+
+from .lines import line_catalog, add_lines, _render_rfft, _add_sinusoids
+
+# numpy >= 2 can write inverse FFTs into a given array
+_fft_out = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+# Frequency bins of the `bucket_noise` spectrum built at once
+_block_bins = 2**14
 
 # These are the things that get imported when running `from foo import *`
-__all__ = ['bucket_noise', 'get_lines']
+__all__ = ['bucket_noise', 'compose_background', 'nonstationary_noise',
+           'iter_nonstationary_noise', 'get_lines']
 
 
 def bucket_noise(
@@ -13,7 +22,8 @@ def bucket_noise(
         norm_amp=2.2e-20,
         zeros=None,
         poles=None,
-        seed=None, ):
+        seed=None,
+        out=None, ):
     """
     Generate noise with approximate spectral properties of aLIGO noise
     curve.
@@ -44,6 +54,12 @@ def bucket_noise(
         is ``None``, the `RandomState` will try to read data from
         ``/dev/urandom`` (or the Windows analogue) if available or seed
         from the clock otherwise. Defaults to ``None``.
+    out : ndarray, shape (sec*fs,), optional
+        Preallocated output array. The spectrum is built in blocks of
+        frequencies, and if `sec*fs` is a power of two the inverse FFT is
+        written straight into `out` (with numpy >= 2), so the spectrum is
+        the only other full-length array. Otherwise the padded transform
+        is a temporary.
 
     Returns
     -------
@@ -67,16 +83,311 @@ def bucket_noise(
 
     nscale = fs * np.sqrt(Nfft / fs / 2)  # To normalize to unity ASD
 
+    # Random phases times the shape, built up in place in the spectrum a
+    # block of frequencies at a time. The phases are drawn in the same
+    # order as all at once, and the bins as `np.fft.rfftfreq` makes them.
+    rfft_data = np.zeros(Nfft // 2 + 1, dtype=np.complex128)
+    # The remainder goes into the last block: the shape of a lone bin, such
+    # as the Nyquist bin left over here, is not rounded the same as the
+    # shape of the whole array is
+    df = 1.0 / (Nfft * (1 / fs))
+    n_blocks = max(1, rfft_data.size // _block_bins)
+    for b in range(n_blocks):
+        start = b * _block_bins
+        stop = start + _block_bins if b < n_blocks - 1 else rfft_data.size
+        block = rfft_data[start:stop]
+        phasors = block[1:] if start == 0 else block
+        phasors.real = state.uniform(low=-np.pi, high=np.pi,
+                                     size=phasors.size)
+        phasors *= 1j
+        np.exp(phasors, out=phasors)
+        phasors *= nscale
+        freqs = np.arange(start, stop) * df
+        block *= _asd_shape(freqs, zeros, poles, norm_freq, norm_amp)
+    del freqs, block, phasors
+
+    return _irfft_into(rfft_data, Nfft, N, out)
+
+
+def compose_background(sec, fs, components=None, catalog=None, seed=None,
+                       out=None):
+    """
+    Generate stationary noise made of any number of spectral components
+    and lines in a single inverse FFT.
+
+    The PSDs of the components are summed and synthesized like
+    `bucket_noise`. Broadened lines and coherent lines that fall exactly
+    on a frequency bin are rendered into the same spectrum, so adding
+    components costs no extra full-length passes. Only coherent lines off
+    the bin grid, or with wandering frequency, are added in the time
+    domain afterwards. The transform length is the next FFT-friendly
+    length of ``sec*fs`` rather than the next power of two.
+
+    Parameters
+    ----------
+    sec : integer
+        Length of time series in seconds.
+    fs : integer
+        Sampling frequency of time series in Hz.
+    components : sequence, optional
+        Independent noise components. Each is either a dict of
+        `bucket_noise` shape keywords (`norm_freq`, `norm_amp`, `zeros`,
+        `poles`), with missing ones taking the `bucket_noise` defaults, or
+        a callable mapping frequencies in Hz to an ASD in 1/sqrt(Hz), such
+        as a `TabulatedASD`. If ``None``, uses the default `bucket_noise`
+        shape alone.
+    catalog : recarray or sequence of recarray, optional
+        Lines to add, as made by `lines.line_catalog`, with absolute
+        amplitudes. If ``None``, uses the default lines of `get_lines`.
+        Pass an empty list for no lines.
+    seed : int or np.random.RandomState instance, optional
+        If an integer, used as the seed for a new
+        `np.random.RandomState` instance that generates the timeseries.
+        If an instance of `RandomState`, it is used directly. Defaults to
+        ``None``.
+    out : ndarray, shape (sec*fs,), optional
+        Preallocated output array.
+
+    Returns
+    -------
+    data : ndarray, shape (sec*fs,)
+        Time series with the summed spectrum.
+    """
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    if components is None:
+        components = [{}]
+    if catalog is None:
+        catalog = mains_lines()
+        catalog.amp *= 1e-19 / np.max(catalog.amp)
+    elif not isinstance(catalog, np.ndarray):
+        catalog = np.concatenate([np.asarray(c) for c in catalog] or
+                                 [line_catalog([])]).view(np.recarray)
+
+    N = int(sec * fs)
+    Nfft = next_fast_len(N, real=True)
+
+    # Sum of the component PSDs, as an ASD
+    asd = np.zeros(Nfft // 2 + 1)
+    for component in components:
+        asd += _grid_asd(Nfft, fs, component)**2
+    np.sqrt(asd, out=asd)
+
+    nscale = fs * np.sqrt(Nfft / fs / 2)  # To normalize to unity ASD
     angles = state.uniform(low=-np.pi, high=np.pi, size=Nfft // 2)
     rfft_data = np.zeros(Nfft // 2 + 1, dtype=np.complex128)
+    rfft_data[1:] = np.exp(1j * angles)
+    del angles
+    rfft_data *= asd
+    rfft_data *= nscale
+    del asd
+
+    rest, phases = _render_rfft(rfft_data, Nfft, fs, catalog, state)
+
+    data = _irfft_into(rfft_data, Nfft, N, out)
+    del rfft_data
+    if rest.size:
+        _add_sinusoids(data, fs, rest, phases, state, wander_time=10)
+
+    return data
+
+
+def nonstationary_noise(sec, fs, knots, shapes=None, gains=None,
+                        frame_sec=8, seed=None, out=None):
+    """
+    Generate non-stationary noise whose ASD follows a schedule over time.
+
+    The ASD is specified at a set of knot times, either as a bucket shape
+    per knot, a broadband gain per knot, or both, and linearly interpolated
+    in between. The series is synthesized frame by frame in the frequency
+    domain, like `bucket_noise`, and the frames are joined by windowed
+    overlap-add. Frames use a sine window with 50% overlap, whose squares
+    sum to one, so stationary stretches keep the ASD of `bucket_noise`.
+    Cost is O(N log frame) and only a couple of frames are held in memory;
+    see `iter_nonstationary_noise` for the streaming version.
+
+    Parameters
+    ----------
+    sec : integer
+        Length of time series in seconds.
+    fs : integer
+        Sampling frequency of time series in Hz.
+    knots : array_like, shape (M,)
+        Increasing times in seconds where the ASD is specified. Before the
+        first and after the last knot the ASD is held constant.
+    shapes : sequence, optional
+        One shape per knot: a dict of `bucket_noise` shape keywords
+        (`norm_freq`, `norm_amp`, `zeros`, `poles`), with missing ones
+        taking the `bucket_noise` defaults, or an ASD callable such as a
+        `TabulatedASD`. If ``None``, every knot uses the default bucket
+        shape.
+    gains : array_like, shape (M,), optional
+        Broadband amplitude gain at each knot, applied on top of `shapes`.
+        Defaults to 1.
+    frame_sec : float
+        Length of the synthesis frames in seconds. This sets the frequency
+        resolution of the ASD and how fast it can change. Defaults to 8 s.
+    seed : int or np.random.RandomState instance, optional
+        If an integer, used as the seed for a new
+        `np.random.RandomState` instance that generates the timeseries.
+        If an instance of `RandomState`, it is used directly. Defaults to
+        ``None``.
+    out : ndarray, shape (sec*fs,), optional
+        Preallocated output array.
+
+    Returns
+    -------
+    data : ndarray, shape (sec*fs,)
+        Time series with time-varying ASD.
+    """
+    N = int(sec * fs)
+    if out is None:
+        out = np.empty(N)
+
+    start = 0
+    for chunk in iter_nonstationary_noise(sec, fs, knots, shapes=shapes,
+                                          gains=gains, frame_sec=frame_sec,
+                                          seed=seed):
+        out[start:start + chunk.size] = chunk
+        start += chunk.size
+
+    return out
+
+
+def iter_nonstationary_noise(sec, fs, knots, shapes=None, gains=None,
+                             frame_sec=8, seed=None):
+    """
+    Streaming version of `nonstationary_noise`.
+
+    Yields consecutive chunks of half a frame each (the last one may be
+    shorter) that together make up the ``sec*fs`` samples. Each frame
+    draws from its own random stream derived from `seed` and the frame
+    index, so any part of the series can be regenerated on its own.
+    """
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    N = int(sec * fs)
+    L = 2 * int(np.ceil(frame_sec * fs / 2))
+    H = L // 2
+    base_seed = state.randint(2**31 - 1)
+
+    knots = np.atleast_1d(np.asarray(knots, dtype=float))
+    knot_asds = _knot_asds(L, fs, knots, shapes, gains)
+    window = np.sin(np.pi * (np.arange(L) + 0.5) / L)
+
+    # Frame j covers samples [(j - 1) H, (j + 1) H)
+    tail = _ola_frame(0, base_seed, L, fs, knots, knot_asds, window)[H:]
+    for start in range(0, N, H):
+        j = start // H + 1
+        frame = _ola_frame(j, base_seed, L, fs, knots, knot_asds, window)
+        tail += frame[:H]
+        yield tail[:N - start]
+        tail = frame[H:]
+
+
+def _knot_asds(L, fs, knots, shapes, gains):
+    '''
+    ASD magnitude at each knot on the grid of `L`-sample frames, shape
+    (M, L // 2 + 1)
+    '''
+    if shapes is None:
+        shapes = [{}] * knots.size
+    if gains is None:
+        gains = np.ones(knots.size)
+    gains = np.broadcast_to(np.asarray(gains, dtype=float), knots.size)
+    if len(shapes) != knots.size:
+        raise ValueError('Need one shape per knot')
+
+    asds = np.empty((knots.size, L // 2 + 1))
+    for ii, (shape, gain) in enumerate(zip(shapes, gains)):
+        asds[ii] = gain * _grid_asd(L, fs, shape)
+    return asds
+
+
+def _grid_asd(n, fs, component):
+    '''
+    ASD magnitude of one noise component on the `rfft` grid of an
+    `n`-sample series. Components that cache their grids, like
+    `TabulatedASD`, are asked for it directly.
+    '''
+    if hasattr(component, 'rfft_asd'):
+        return component.rfft_asd(n, fs)
+    return _component_asd(np.fft.rfftfreq(n, d=1 / fs), component)
+
+
+def _component_asd(freqs, component):
+    '''
+    ASD magnitude of one noise component on a frequency grid. The component
+    is either a dict of `bucket_noise` shape keywords or a callable that
+    maps frequencies in Hz to an ASD.
+    '''
+    if callable(component):
+        return np.abs(np.broadcast_to(component(freqs), freqs.shape))
+
+    kwargs = dict(_bucket_shape_defaults)
+    kwargs.update(component)
+    if kwargs['poles'] is None:
+        kwargs['poles'] = [5] * 2
+    if kwargs['zeros'] is None:
+        kwargs['zeros'] = [24] * 2 + [350]
+    return np.abs(_asd_shape(freqs, **kwargs))
+
+
+def _ola_segment(start, n, fs, L, base_seed, knots, knot_asds, window):
+    '''
+    Samples [start, start + n) of the overlap-added series, summing only
+    the frames that cover them
+    '''
+    H = L // 2
+    out = np.zeros(n)
+    for j in range(start // H, (start + n - 1) // H + 2):
+        f_start = (j - 1) * H
+        lo = max(start, f_start)
+        hi = min(start + n, f_start + L)
+        if hi <= lo:
+            continue
+        frame = _ola_frame(j, base_seed, L, fs, knots, knot_asds, window)
+        out[lo - start:hi - start] += frame[lo - f_start:hi - f_start]
+    return out
+
+
+def _ola_frame(j, base_seed, L, fs, knots, knot_asds, window):
+    '''
+    One windowed synthesis frame, centered at sample j * L / 2
+    '''
+    state = np.random.RandomState([base_seed, j])
+    t_mid = j * (L // 2) / fs
+
+    kk = np.searchsorted(knots, t_mid) - 1
+    if kk < 0:
+        asd = knot_asds[0]
+    elif kk >= knots.size - 1:
+        asd = knot_asds[-1]
+    else:
+        frac = (t_mid - knots[kk]) / (knots[kk + 1] - knots[kk])
+        asd = (1 - frac) * knot_asds[kk] + frac * knot_asds[kk + 1]
+
+    nscale = fs * np.sqrt(L / fs / 2)  # To normalize to unity ASD
+    angles = state.uniform(low=-np.pi, high=np.pi, size=L // 2)
+    rfft_data = np.zeros(L // 2 + 1, dtype=np.complex128)
     rfft_data[1:] = nscale * np.exp(1j * angles)
 
-    freqs = np.fft.rfftfreq(Nfft, d=1 / fs)
-    shape = _asd_shape(freqs, zeros, poles, norm_freq, norm_amp)
+    return np.fft.irfft(rfft_data * asd, n=L) * window
 
-    data = np.fft.irfft(rfft_data * shape)
 
-    return data[:N]
+# Shape keywords of `bucket_noise`, with its defaults
+_bucket_shape_defaults = {
+    'norm_freq': 100,
+    'norm_amp': 2.2e-20,
+    'zeros': None,
+    'poles': None,
+}
 
 
 def _asd_shape(freqs, zeros, poles, norm_freq, norm_amp):
@@ -85,8 +396,36 @@ def _asd_shape(freqs, zeros, poles, norm_freq, norm_amp):
     zeros = -1j * np.asarray(zeros)[:, np.newaxis]
 
     norm = norm_amp * np.prod(norm_freq - poles) / np.prod(norm_freq - zeros)
-    resp = np.prod(freqs - zeros, axis=0) / np.prod(freqs - poles, axis=0)
-    return norm * resp
+    # Products over the roots one at a time, rather than over a stacked
+    # (roots, freqs) array
+    resp = _root_product(freqs, zeros)
+    resp /= _root_product(freqs, poles)
+    return np.multiply(norm, resp, out=resp)
+
+
+def _root_product(freqs, roots):
+    '''
+    Product of ``freqs - root`` over `roots`, shape (R, 1), in one array.
+    '''
+    prod = np.ones(freqs.shape, dtype=np.complex128)
+    for root in roots[:, 0]:
+        prod *= freqs - root
+    return prod
+
+
+def _irfft_into(spectrum, n, N, out=None):
+    '''
+    First `N` samples of the inverse real FFT of length `n` of `spectrum`,
+    in `out` if given. The transform is written straight into `out` when
+    numpy supports it and no padding is cut off; otherwise it is copied.
+    '''
+    if out is not None and N == n and _fft_out:
+        return np.fft.irfft(spectrum, n=n, out=out)
+    data = np.fft.irfft(spectrum, n=n)[:N]
+    if out is not None:
+        out[:] = data
+        data = out
+    return data
 
 
 def _nextpow2(n):
@@ -94,9 +433,10 @@ def _nextpow2(n):
     return 2**p
 
 
-def get_lines(sec, fs, peak_amp=1e-19, seed=None):
+def get_lines(sec, fs, peak_amp=1e-19, seed=None, catalog=None,
+              method='fft', out=None):
     """
-    Generate line noise at 60Hz and harmonics
+    Generate line noise at 60Hz and harmonics, or from a line catalog.
 
     Parameters
     ----------
@@ -104,8 +444,10 @@ def get_lines(sec, fs, peak_amp=1e-19, seed=None):
         Length of time series in seconds.
     fs : integer
         Sampling frequency of time series in Hz. Defaults to 2048 Hz
-    peak_amp : float
-        Amplitude of strongest harmonic. Defaults to 1e-19.
+    peak_amp : float or None
+        Amplitude of strongest line. The catalog amplitudes are treated as
+        relative and rescaled to this. If ``None``, the catalog amplitudes
+        are used as they are. Defaults to 1e-19.
     seed : int or np.random.RandomState instance, optional
         If an integer, used as the seed for a new
         `np.random.RandomState` instance that generates the timeseries.
@@ -113,6 +455,13 @@ def get_lines(sec, fs, peak_amp=1e-19, seed=None):
         is ``None``, the `RandomState` will try to read data from
         ``/dev/urandom`` (or the Windows analogue) if available or seed
         from the clock otherwise. Defaults to ``None``.
+    catalog : recarray, optional
+        Lines to generate, as made by `lines.line_catalog`. If ``None``,
+        uses 60 Hz mains and its first two harmonics. Defaults to ``None``.
+    method : {'fft', 'sos'}
+        How broadened lines are rendered, see `lines.add_lines`.
+    out : ndarray, shape (sec*fs,), optional
+        Preallocated output array. Its contents are overwritten.
 
     Returns
     -------
@@ -125,40 +474,46 @@ def get_lines(sec, fs, peak_amp=1e-19, seed=None):
     else:
         state = np.random.RandomState(seed)
 
-    line_freqs = [60, 120, 180]
-    relative_amplitudes = [1, .2, .5]
-    line_phases = state.uniform(-np.pi, np.pi, size=len(line_freqs))
-
-    maxA = 0
-    tt = np.arange(sec * fs) / fs
-    out = np.zeros_like(tt)
+    if catalog is None:
+        catalog = mains_lines()
 
-    for ii, freq in enumerate(line_freqs):
-        if freq < 0.8 * (fs / 2):  # Sub-nyquist, ok to add line
+    if peak_amp is not None:
+        # Normalize to the strongest line that will actually be added
+        audible = catalog.freq < 0.8 * (fs / 2)
+        maxA = np.max(catalog.amp[audible]) if np.any(audible) else 0
+        if maxA > 0:
+            catalog = catalog.copy()
+            catalog.amp *= peak_amp / maxA
 
-            A = relative_amplitudes[ii]
-            w = 2 * np.pi * freq
-            phi = line_phases[ii]
-            out += A * np.sin(w * tt + phi)
-            maxA = max(maxA, A)
+    if out is None:
+        out = np.zeros(int(sec * fs))
+    else:
+        out[:] = 0
+    return add_lines(out, fs, catalog, seed=state, method=method)
 
-    if maxA > 0 :
-        out *= peak_amp / maxA
 
-    return out
+def mains_lines():
+    """
+    Catalog of the 60 Hz mains line and its first two harmonics, with
+    relative amplitudes.
+    """
+    return line_catalog([60, 120, 180], amp=[1, .2, .5])
 
 
 def iir_bp(fstops, fs, order=4):
     """
-    the opposite of a notch filter: return coefficients to add a spectral line
+    the opposite of a notch filter: return a bank of filters to add spectral
+    lines
+
+    Each line gets its own elliptic bandpass in SOS form, rather than one
+    high-order transfer function, so that many lines stay numerically
+    stable. The result has shape (n_lines, n_sections, 6); apply it as a
+    parallel bank by summing the `utils.sosfilt_bank` outputs.
     """
     nyq = 0.5 * fs
 
-    # Zeros zd, poles pd, and gain kd for the digital filter
-    zd = np.array([])
-    pd = np.array([])
-
     # Lines
+    banks = []
     for fstopData in fstops:
         fstop = fstopData[0]
         df = fstopData[1]
@@ -167,14 +522,16 @@ def iir_bp(fstops, fs, order=4):
         high = (fstop + df) / nyq
         low2 = (fstop - df2) / nyq
         high2 = (fstop + df2) / nyq
-        z, p, k = sig.iirdesign([low2, high2], [low, high],
-                                gpass=1,
-                                gstop=6,
-                                ftype='ellip',
-                                output='zpk')
-        zd = np.append(zd, z)
-        pd = np.append(pd, p)
-
-    # Return the numerator and denominator of the digital filter
-    b, a = sig.zpk2tf(zd, pd, k)
-    return b, a
+        sos = sig.iirdesign([low2, high2], [low, high],
+                            gpass=1,
+                            gstop=6,
+                            ftype='ellip',
+                            output='sos')
+        banks.append(sos)
+
+    # Pad with identity sections so the filters stack
+    n_sec = max(sos.shape[0] for sos in banks)
+    identity = np.array([1., 0, 0, 1, 0, 0])
+    return np.stack([np.concatenate([sos, np.tile(identity,
+                                                  (n_sec - len(sos), 1))])
+                     for sos in banks])
@@ -2,6 +2,10 @@ from __future__ import division
 import numpy as np
 
 from .mock_bg import bucket_noise, get_lines
+from .glitches import random_glitches, inject_glitches
+from .planner import plan_generation
+from .timeaxis import TimeAxis
+from .lazyaux import LazyAux
 from . import scatter
 from . import bilinear
 from . import resonance
@@ -22,7 +26,8 @@ asd_d = 2e-20  # noise level (m/rHz) of bucket
 
 
 def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
-                  parse_str=''):
+                  parse_str='', glitches=None, max_memory=None,
+                  retain_aux=True):
     '''
     Integrated function for nonlinear noise subtraction investigations.
 
@@ -47,11 +52,27 @@ def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
         is ``None``, the `RandomState` will try to read data from
         ``/dev/urandom`` (or the Windows analogue) if available or seed
         from the clock otherwise. Defaults to ``None``.
+    glitches : int or recarray, optional
+        Transients to add to the target, either a table made by
+        `glitches.glitch_table` or a number of random ones to draw with
+        `glitches.random_glitches`. The injected table is returned in
+        ``aux['glitches']``. Defaults to ``None``.
+    max_memory : int, optional
+        Memory budget in bytes. If the estimated peak memory (see
+        `planner.estimate_memory`) is over budget, the data are made with
+        `chunked.chunked_starting_data` instead, which gives a different
+        realization for the same seed. Raises `MemoryError` if that does
+        not fit either. Defaults to ``None``, no limit.
+    retain_aux : bool, optional
+        If False, intermediates that are only needed for `aux` entries are
+        dropped as soon as possible, and those entries are left out.
+        Defaults to True.
 
     Returns
     -------
-    times : ndarray
-        Array of times
+    times : TimeAxis
+        Sample times. Materialize them with ``np.asarray(times)`` if an
+        actual array is needed.
     background : ndarray
         Array of mock DARM background with no additional noise added, to
         be used to evaluate the regression efficacy.
@@ -60,10 +81,13 @@ def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
         subtraction target
     wit : ndarray, shape (N, tar.size)
         N witness signals used as input to nonlinear regression methods.
-    aux : Dict
+    aux : LazyAux
         Python dictionary containing auxiliary data that may vary depending on
         the noise model being used. For instance, "perfect" witnesses,
-        intermediate signals, or best case regression results.
+        intermediate signals, or best case regression results. Costly
+        entries are only computed when first read. Entries do not depend
+        on the returned arrays, so those may be modified in place, e.g.
+        to normalize the witnesses, before the entries are read.
 
     Models
     ------
@@ -76,9 +100,9 @@ def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
     # To add a new noise model #
     ############################
     #  - Add the string ID to the `known_models` list at the top of the file
-    #  - Add an `elif` to the if block and call your model-specific functions
-    #    in there. I.e.:
-    #      - Add any keywords or aruments your model needs to the parser
+    #  - Add any keywords or aruments your model needs to `_model_parser`
+    #  - Add an `elif` to the if block in `_model_noise` and call your
+    #    model-specific functions in there. I.e.:
     #      - Generate witness data streams
     #      - Define and apply any nonlinear functions & filters
     #      - Create the list of witnesses to be used in the regression in a
@@ -94,38 +118,54 @@ def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
     else:
         state = np.random.RandomState(seed)
 
-    times = np.linspace(0, sec, fs * sec, endpoint=False)
+    if max_memory is not None:
+        block_sec, _ = plan_generation(sec, fs, model, parse_str, max_memory)
+        if block_sec is not None:
+            from .chunked import chunked_starting_data
+            times, background, target, witnesses, aux = \
+                chunked_starting_data(sec, fs, model, seed=state,
+                                      parse_str=parse_str,
+                                      block_sec=block_sec, workers=1)
+            if glitches is not None:
+                if np.isscalar(glitches):
+                    glitches = random_glitches(glitches, sec, seed=state)
+                inject_glitches(target, fs, glitches, aux=aux)
+            return times, background, target, witnesses, aux
+
+    times = TimeAxis.from_seconds(sec, fs)
     background = bucket_noise(sec, fs, seed=state)
     background += get_lines(sec, fs, seed=state)
 
-    aux = {}  # Define in case we don't want to use it.
-    parser = argparse.ArgumentParser(prog='-k')
+    aux = LazyAux()  # Define in case we don't want to use it.
+    args = _model_parser(model).parse_args(parse_str)
+    coupled_noise, witnesses = _model_noise(model, args, sec, fs, state, aux,
+                                            retain_aux)
+
+    # The coupled noise buffer, allocated once the witnesses are made,
+    # becomes the target, so no full-length temporary is needed here
+    target = coupled_noise
+    del coupled_noise
+    target += background
+
+    if glitches is not None:
+        if np.isscalar(glitches):
+            glitches = random_glitches(glitches, sec, seed=state)
+        inject_glitches(target, fs, glitches, aux=aux)
+
+    return times, background, target, witnesses, aux
 
-    if model == 'scatter':
-        parser.add_argument(
-            '-p',
-            '--random_phase',
-            action='store_true',
-            help='Invoke to randomize phase of audio band sine waves.')
-        parser.add_argument(
-            '-f',
-            '--filt_seismic',
-            action='store_true',
-            help='Invoke to apply low-pass filter to seismic witness.')
-        parser.add_argument(
-            '-r',
-            '--relevant',
-            type=int,
-            default=2,
-            help='Number of relevant witnesses to include.')
-        parser.add_argument(
-            '-i',
-            '--irrelevant',
-            type=int,
-            default=0,
-            help='Number of irrelevant witnesses to include.')
 
-        args = parser.parse_args(parse_str)
+def _model_noise(model, args, sec, fs, state, aux, retain_aux=True,
+                 out=None):
+    '''
+    Witnesses and coupled noise of a model, as in `starting_data`, drawn
+    from `state`. `args` are the parsed model keywords. Model-specific
+    entries are put in `aux`. The coupled noise is written to `out` if
+    given.
+    '''
+    native_fs = 'auto' if getattr(args, 'native_rate', False) else None
+
+    if model == 'scatter':
         rand_phase = args.random_phase
         filt_seismic = args.filt_seismic
         rel = args.relevant
@@ -136,78 +176,162 @@ def starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
                                        fs=fs,
                                        seed=state,
                                        rand_phase=rand_phase,
-                                       filt_seismic=filt_seismic)
+                                       filt_seismic=filt_seismic,
+                                       noise_amp=args.witness_noise,
+                                       distinct_irrelevant=args.distinct_irrelevant,
+                                       native_fs=native_fs)
 
-        coupled_noise = scatter.coupling_func(y1, y2)
+        coupled_noise = scatter.coupling_func(y1, y2, out=out)
 
         witnesses = wits
-        aux['y1'] = y1
-        aux['y2'] = y2
+        if retain_aux:
+            aux['y1'] = y1
+            aux['y2'] = y2
+        del y1, y2
 
     elif model == 'bilinear':
-        parser.add_argument(
-            '-p',
-            '--pairs',
-            type=int,
-            default=1,
-            help='Number of beam spot + angular motion channel pairs to '
-                 'return, all of which contribute noise via the bilinear '
-                 'coupling.')
-
-        args = parser.parse_args(parse_str)
         pairs = args.pairs
 
         if pairs < 1 or pairs % 1 != 0 :
             raise ValueError('Pairs must be a positive integer')
 
-        coupled_noise = 0
-        ideal_estimate = 0
         beam_motions = []
         angular_controls = []
         true_beam = []
         true_angular = []
 
-        for _ in range(pairs):
-            witness, true_motion = bilinear.witness(sec, fs, seed=state)
+        for p in range(pairs):
+            witness, true_motion = bilinear.witness(sec, fs, seed=state,
+                                                    native_fs=native_fs)
 
-            coupled_noise += bilinear.coupling_func(true_motion)
-            ideal_estimate += bilinear.ideal_estimate(witness, fs)
+            # The first pair is written straight to the output. A scratch
+            # array for the others would be alive over the next pair's
+            # witness generation, where the peak is, so they are not kept
+            if p == 0:
+                coupled_noise = bilinear.coupling_func(true_motion, out=out)
+            else:
+                coupled_noise += bilinear.coupling_func(true_motion)
 
             beam_motions.append(witness[0])
             angular_controls.append(witness[1])
 
-            true_beam.append(true_motion[0])
-            true_angular.append(true_motion[1])
+            if retain_aux:
+                true_beam.append(true_motion[0])
+                true_angular.append(true_motion[1])
+            del witness, true_motion
 
         witnesses = np.stack(beam_motions + angular_controls)
-        true_motions = np.stack(true_beam + true_angular)
 
-        aux = {}
-        aux['true_motions'] = true_motions
-        aux['ideal_estimate'] = ideal_estimate
+        if retain_aux:
+            # The pairs' own rows, not the returned copies, which callers
+            # may change in place before reading the estimate
+            pair_rows = beam_motions + angular_controls
+            aux.defer('true_motions',
+                      lambda: np.stack(true_beam + true_angular))
+            aux.defer('ideal_estimate',
+                      lambda: bilinear.ideal_estimate_pairs(pair_rows, fs))
+        del beam_motions, angular_controls
         aux['Npairs'] = pairs
 
     elif model == 'resonance':
-        default_freq = 9.3*np.sqrt(2)
+        print('Quality: {}'.format(args.quality))
+        print('Resonant frequency: {}'.format(args.frequency))
+
+        w0 = 2*np.pi*np.asarray(args.frequency)
+        coupled_noise, witnesses = resonance.witness(
+            sec=sec, fs=fs, w0=w0, Q=args.quality, gain=args.gain,
+            seed=state)
+        if out is not None:
+            out[:] = coupled_noise
+            coupled_noise = out
+
+    return coupled_noise, witnesses
+
+
+def _model_parser(model):
+    '''
+    Argument parser for the model-specific keywords in `parse_str`.
+    '''
+    parser = argparse.ArgumentParser(prog='-k')
+
+    if model == 'scatter':
+        parser.add_argument(
+            '-p',
+            '--random_phase',
+            action='store_true',
+            help='Invoke to randomize phase of audio band sine waves.')
+        parser.add_argument(
+            '-f',
+            '--filt_seismic',
+            action='store_true',
+            help='Invoke to apply low-pass filter to seismic witness.')
+        parser.add_argument(
+            '-r',
+            '--relevant',
+            type=int,
+            default=2,
+            help='Number of relevant witnesses to include.')
+        parser.add_argument(
+            '-i',
+            '--irrelevant',
+            type=int,
+            default=0,
+            help='Number of irrelevant witnesses to include.')
+        parser.add_argument(
+            '-d',
+            '--distinct_irrelevant',
+            action='store_true',
+            help='Invoke to make each irrelevant seismic witness an '
+                 'independent realization instead of a copy.')
+        parser.add_argument(
+            '-n',
+            '--witness_noise',
+            type=float,
+            default=0,
+            help='Scale of the sensing noise added to the seismic '
+                 'witnesses (m). Defaults to 0.')
+        parser.add_argument(
+            '--native_rate',
+            action='store_true',
+            help='Invoke to generate the seismic witnesses at a lower '
+                 'native rate and upsample them.')
+
+    elif model == 'bilinear':
+        parser.add_argument(
+            '-p',
+            '--pairs',
+            type=int,
+            default=1,
+            help='Number of beam spot + angular motion channel pairs to '
+                 'return, all of which contribute noise via the bilinear '
+                 'coupling.')
+        parser.add_argument(
+            '--native_rate',
+            action='store_true',
+            help='Invoke to generate the beam spot and ASC motion at lower '
+                 'native rates and upsample them.')
+
+    elif model == 'resonance':
+        default_freq = float(9.3*np.sqrt(2))
         parser.add_argument('-q','--quality',
                             type=float,
+                            nargs='+',
                             dest='quality',
-                            default=100,
-                            help='quality factor')
+                            default=[100],
+                            help='quality factor, one per mode or one for '
+                                 'all')
         parser.add_argument('-f', '-frequency',
                             type=float,
+                            nargs='+',
                             dest='frequency',
-                            default=default_freq,
-                            help='resonant frequency (Hz)')
-        args = parser.parse_args(parse_str)
-
-        print('Quality: {}'.format(args.quality))
-        print('Resonant frequency: {}'.format(args.frequency))
-
-        w0 = 2*np.pi*args.frequency
-        coupled_noise, witnesses = resonance.witness(
-            sec=sec, fs=fs, w0=w0, Q=args.quality)
-
-    target = coupled_noise + background
+                            default=[default_freq],
+                            help='resonant frequency (Hz) of each mode')
+        parser.add_argument('-g', '--gain',
+                            type=float,
+                            nargs='+',
+                            dest='gain',
+                            default=[1],
+                            help='relative gain, one per mode or one for '
+                                 'all')
 
-    return times, background, target, witnesses, aux
+    return parser
@@ -0,0 +1,145 @@
+from __future__ import division
+import numpy as np
+
+from .mock_bg import bucket_noise, compose_background, get_lines
+from .mock_noise import known_models, _model_parser, _model_noise
+from .mock_noise import sec_d, fs_d
+from .timeaxis import TimeAxis
+from .lazyaux import LazyAux
+
+__all__ = ['network_data', 'schumann_asd']
+
+# Schumann resonances: frequencies in Hz, quality factors, and field ASD at
+# the peaks in T/sqrt(Hz)
+_schumann_freqs = np.array([7.8, 14.3, 20.8, 27.3, 33.8])
+_schumann_qs = np.array([4.0, 4.5, 5.0, 5.5, 6.0])
+_schumann_amps = 1e-12 * np.array([1.0, 0.7, 0.5, 0.35, 0.25])
+
+
+def schumann_asd(freqs):
+    '''
+    ASD of the global magnetic field noise in T/sqrt(Hz): the first five
+    Schumann resonances as Lorentzian peaks, summed in power.
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+    psd = np.zeros(freqs.shape)
+    for f0, q, amp in zip(_schumann_freqs, _schumann_qs, _schumann_amps):
+        psd += amp**2 / (1 + ((freqs - f0) * 2 * q / f0)**2)
+    return np.sqrt(psd)
+
+
+def network_data(detectors=('H1', 'L1'), sec=sec_d, fs=fs_d,
+                 model='scatter', seed=None, parse_str='', magnetic_amp=1e-19,
+                 magnetic_gains=None, magnetometer_noise=5e-14,
+                 retain_aux=True):
+    '''
+    Generate `starting_data` style data for a network of detectors that
+    share common-mode noise.
+
+    The shared sources are made once and fanned out to every detector:
+
+      - the mains lines, a single realization added to each background,
+      - the global magnetic field (Schumann resonances, see
+        `schumann_asd`), which couples into each target with the
+        detector's gain and is seen by a magnetometer witness at each
+        site, with its own sensor noise.
+
+    Each detector then draws its own bucket background and the witnesses
+    and coupled noise of `model` from an independent random stream, so
+    the local parts are uncorrelated between detectors. Light travel
+    delays between sites are ignored.
+
+    Parameters
+    ----------
+    detectors : sequence of str
+        Detector names. Defaults to ('H1', 'L1').
+    sec, fs, model, seed, parse_str, retain_aux
+        As for `starting_data`. The model keywords apply to all detectors.
+    magnetic_amp : float
+        ASD the magnetic coupling adds to a target at the first Schumann
+        peak, for a gain of 1. Defaults to 1e-19.
+    magnetic_gains : array_like, optional
+        Magnetic coupling gain per detector. Defaults to 1 for all.
+    magnetometer_noise : float
+        White sensor noise ASD of the magnetometers in T/sqrt(Hz).
+        Defaults to 5e-14.
+
+    Returns
+    -------
+    times : TimeAxis
+        Sample times, shared by all detectors.
+    background : ndarray, shape (detector, time)
+        Local background plus the shared lines.
+    target : ndarray, shape (detector, time)
+        Background with the model and magnetic noise added.
+    witnesses : ndarray, shape (detector, channel, time)
+        The model witnesses of each detector, followed by its
+        magnetometer.
+    aux : LazyAux
+        'detectors', 'channels' (names of the witness rows), and, with
+        `retain_aux`, the shared 'magnetic_field' and 'lines', plus each
+        detector's model aux under its name.
+    '''
+    if model not in known_models:
+        raise ValueError('Unknown noise model type: {}'.format(model))
+
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    args = _model_parser(model).parse_args(parse_str)
+    detectors = list(detectors)
+    D = len(detectors)
+    if magnetic_gains is None:
+        magnetic_gains = np.ones(D)
+    magnetic_gains = np.broadcast_to(np.asarray(magnetic_gains, dtype=float),
+                                     D)
+    local_seeds = state.randint(2**31 - 1, size=D)
+
+    # Shared sources
+    N = int(sec * fs)
+    times = TimeAxis(N, fs)
+    lines = get_lines(sec, fs, seed=state)
+    field = compose_background(sec, fs, components=[schumann_asd], catalog=[],
+                               seed=state)
+    coupling = magnetic_amp / _schumann_amps[0]
+
+    background = np.empty((D, N))
+    target = np.empty((D, N))
+    witnesses = None
+    aux = LazyAux(detectors=detectors)
+
+    for d, detector in enumerate(detectors):
+        local = np.random.RandomState(local_seeds[d])
+        local_aux = LazyAux()
+
+        bucket_noise(sec, fs, seed=local, out=background[d])
+        background[d] += lines
+        _, wits = _model_noise(model, args, sec, fs, local, local_aux,
+                               retain_aux, out=target[d])
+        wits = np.atleast_2d(wits)
+
+        if witnesses is None:
+            witnesses = np.empty((D, wits.shape[0] + 1, N))
+        witnesses[d, :-1] = wits
+        del wits
+        magnetometer = witnesses[d, -1]
+        magnetometer[:] = local.randn(N)
+        magnetometer *= magnetometer_noise * np.sqrt(fs / 2)
+        magnetometer += field
+
+        target[d] += background[d]
+        target[d] += coupling * magnetic_gains[d] * field
+
+        if retain_aux:
+            aux[detector] = local_aux
+
+    aux['channels'] = ['{}_{}'.format(model, ii)
+                       for ii in range(witnesses.shape[1] - 1)] + \
+        ['magnetometer']
+    if retain_aux:
+        aux['magnetic_field'] = field
+        aux['lines'] = lines
+
+    return times, background, target, witnesses, aux
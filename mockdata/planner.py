@@ -0,0 +1,165 @@
+from __future__ import division
+import numpy as np
+from scipy.fft import next_fast_len
+
+from .mock_bg import _nextpow2
+from . import scatter
+from . import resonance
+
+__all__ = ['estimate_memory', 'plan_generation']
+
+# Peak number of full-length float64 arrays alive at once in
+# `starting_data`, per model, as (fixed, per witness row, extra with the
+# seismic low-pass, per scratch row). Scratch rows are the distinct
+# irrelevant seismic channels or resonant modes worked on in one block.
+# Measured with tracemalloc (`python benchmark.py memory`), rounded up.
+_peak_arrays = {
+    'scatter': (4.5, 1.2, 2, 2.5),
+    'bilinear': (7.1, 3, 0, 0),
+    'resonance': (4.75, 0, 0, 2.5),
+}
+
+# Arrays a worker of chunked generation holds per block sample and per
+# warm-up sample, as (fixed, per witness row, extra with the seismic
+# low-pass, with distinct irrelevant channels, with sensing noise).
+# Measured the same way.
+_block_arrays = {
+    'scatter': (4.7, 1.1, 1, 2.7, 1),
+    'bilinear': (18, 3, 0, 0, 0),
+    'resonance': (7, 0, 0, 0, 0),
+}
+_warmup_arrays = {
+    'scatter': (3, 0.2, 1, 0.5, 0),
+    'bilinear': (15, 0.5, 0, 0, 0),
+    'resonance': (3, 0, 0, 0, 0),
+}
+
+# Candidate block lengths for chunked generation, in seconds
+_block_secs = [256, 128, 64, 32, 16, 8, 4]
+
+
+def estimate_memory(sec, fs, model='scatter', parse_str='', chunked=False,
+                    block_sec=None, workers=1):
+    '''
+    Estimate the peak memory of generating data with `starting_data`, or
+    with `chunked_starting_data` if `chunked` is True.
+
+    Parameters
+    ----------
+    sec, fs, model, parse_str
+        As for `starting_data`.
+    chunked : bool
+        Estimate for chunked generation instead. Defaults to False.
+    block_sec : float, optional
+        Block length of chunked generation in seconds. Defaults to that
+        of `chunked_starting_data`.
+    workers : int
+        Number of workers of chunked generation. Each holds the
+        temporaries of one block.
+
+    Returns
+    -------
+    estimate : dict
+        'outputs' is the size of the returned arrays, 'peak' the estimated
+        peak memory, both in bytes. 'rows' is the number of witness rows.
+    '''
+    from .mock_noise import _model_parser, known_models
+
+    if model not in known_models:
+        raise ValueError('Unknown noise model type: {}'.format(model))
+    args = _model_parser(model).parse_args(parse_str)
+
+    N = int(sec * fs)
+    unit = 8 * N  # one float64 array of the full length
+
+    # Optional scatter stages: seismic low-pass, distinct irrelevant
+    # seismic channels and sensing noise
+    stages = (0, 0, 0)
+    scratch = 0
+    if model == 'scatter':
+        rows = args.relevant + args.irrelevant
+        aux_rows = 2
+        distinct = max(0, (args.irrelevant + 1) // 2 - 1) \
+            if args.distinct_irrelevant else 0
+        stages = (int(args.filt_seismic), int(distinct > 0),
+                  int(args.witness_noise != 0))
+        if distinct:
+            scratch = min(distinct, max(1, scatter._block_elements // N))
+    elif model == 'bilinear':
+        rows = 2 * args.pairs
+        aux_rows = 2 * args.pairs + 1
+    else:
+        rows = 1
+        aux_rows = 0
+        modes = np.broadcast(args.frequency, args.quality, args.gain).size
+        scratch = min(modes,
+                      max(1, resonance._max_elements // (N // 2 + 1)))
+
+    # background, target, witnesses and aux; the times are a `TimeAxis`
+    n_outputs = 2 + rows + aux_rows
+    outputs = n_outputs * unit
+
+    if not chunked:
+        fixed, per_row, extra, per_scratch = _peak_arrays[model]
+        model_peak = fixed + per_row * rows + extra * stages[0] + \
+            per_scratch * scratch
+        # `bucket_noise` works on a padded FFT buffer
+        pad = _nextpow2(N) / N
+        peak = unit * (model_peak + pad - 1)
+    else:
+        from .chunked import _block_spec, _frame_sec
+        spec = _block_spec(sec, fs, model, 0, parse_str, block_sec)
+        block_arrays, warmup_arrays = [
+            table[model][0] + table[model][1] * rows +
+            np.dot(table[model][2:], stages)
+            for table in (_block_arrays, _warmup_arrays)]
+        B = min(N, spec['B'])
+        # The warm-up never reaches back past the start of the data
+        warmup = min(spec['warmup'], N - B)
+        frame = 8 * next_fast_len(int(_frame_sec * fs))
+        # Each worker holds its block temporaries, the filtered channels over
+        # the warm-up, and a few background synthesis frames
+        per_worker = 8 * (B * block_arrays + warmup * warmup_arrays) + \
+            4 * frame
+        # The parent also holds one finished block while stitching it in
+        peak = outputs * (1 + B / N) + workers * per_worker
+
+    return {'outputs': int(outputs), 'peak': int(np.ceil(peak)),
+            'rows': rows}
+
+
+def plan_generation(sec, fs, model='scatter', parse_str='', max_memory=None,
+                    workers=1):
+    '''
+    Choose how to generate data within a memory budget.
+
+    Returns ``(None, estimate)`` if `starting_data` fits in `max_memory`
+    bytes as is, or ``(block_sec, estimate)`` for the longest block length,
+    up to the default one, with which `chunked_starting_data` fits.
+
+    Raises
+    ------
+    MemoryError
+        If not even chunked generation fits, e.g. because the outputs
+        alone are too large.
+    '''
+    estimate = estimate_memory(sec, fs, model, parse_str)
+    if max_memory is None or estimate['peak'] <= max_memory:
+        return None, estimate
+
+    # The default block first, as shorter ones filter more warm-up
+    from .chunked import _block_spec
+    default = _block_spec(sec, fs, model, 0, parse_str, None)['B'] / fs
+    for block_sec in [default] + [b for b in _block_secs if b < default]:
+        if block_sec > sec:
+            continue
+        chunked = estimate_memory(sec, fs, model, parse_str, chunked=True,
+                                  block_sec=block_sec, workers=workers)
+        if chunked['peak'] <= max_memory:
+            return block_sec, chunked
+
+    raise MemoryError(
+        'Generating {} s of {} data at {} Hz needs about {:.3g} GB '
+        '({:.3g} GB of outputs), over the budget of {:.3g} GB, even in '
+        'chunks'.format(sec, model, fs, estimate['peak'] / 1e9,
+                        estimate['outputs'] / 1e9, max_memory / 1e9))
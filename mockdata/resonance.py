@@ -1,10 +1,25 @@
 
+from __future__ import division
 import numpy as np
 
+from .utils import zpk_bilinear_bank, array_cache
 
-def witness(sec=16, fs=2048, w0=2*np.pi*np.sqrt(2)*9.3, Q=100, seed=None):
+# Size budget (modes x frequency bins) of the transfer function work array
+_max_elements = 2**22
+# Size budget in bytes of the cached transfer functions
+_cache_bytes = 2**28
+
+
+def witness(sec=16, fs=2048, w0=2*np.pi*np.sqrt(2)*9.3, Q=100, seed=None,
+            gain=1):
     '''
-    TODO: Add comment
+    White noise witness and the target it drives through a bank of
+    resonant modes.
+
+    The target is the witness filtered by the sum of the modes' transfer
+    functions, applied with a real FFT. The transfer function of a given
+    length, sampling rate and mode bank is cached, so repeated calls only
+    pay for the transforms.
 
     Parameters
     ----------
@@ -13,38 +28,95 @@ def witness(sec=16, fs=2048, w0=2*np.pi*np.sqrt(2)*9.3, Q=100, seed=None):
     fs: int
         Sampling frequency of time series in Hz. Defaults to 2048 Hz
         (2**11)
-    w0: int, float
-        Resonant frequency. Defaults to 10.
-    Q: int, float
-        Quality factor. Defaults to 100.
+    w0: float or array_like
+        Resonant frequency of each mode. Defaults to 2 pi sqrt(2) 9.3.
+    Q: float or array_like
+        Quality factor of each mode. Defaults to 100.
     seed: int, np.random.RandomState
         Random seed
+    gain: float or array_like
+        Relative gain of each mode. Defaults to 1.
 
     Returns
     -------
-    targets_t:
-    witnesses_t:
-
+    targets_t: ndarray, shape (sec*fs,)
+        Witness filtered by the resonances.
+    witnesses_t: ndarray, shape (sec*fs,)
+        White noise witness.
     '''
     if isinstance(seed, np.random.RandomState):
         state = seed
     else:
         state = np.random.RandomState(seed)
 
-    # Generate random noise
-    times = np.linspace(0, sec, fs*sec, endpoint=False)
-    dt = times[1] - times[0]  # timestep
-    witnesses_t = state.randn(fs * sec)
+    w0, Q, gain = [tuple(float(x) for x in arr) for arr in
+                   np.broadcast_arrays(np.atleast_1d(w0), np.atleast_1d(Q),
+                                       np.atleast_1d(gain))]
 
-    # FFT
-    freq = np.fft.fftfreq(times.shape[0], d=dt) / (2 * np.pi)
-    witnesses_freq = np.fft.fft(witnesses_t, axis=0)
+    # Generate random noise
+    witnesses_t = state.randn(int(fs * sec))
 
     # Apply transfer function
-    targets_freq = witnesses_freq / (w0**2 - freq**2 + w0*freq*1j/Q)
+    targets_freq = np.fft.rfft(witnesses_t)
+    targets_freq *= transfer_function(witnesses_t.size, fs, w0, Q, gain)
 
-    # inverse FFT
-    targets_t = np.fft.ifft(targets_freq)
+    targets_t = np.fft.irfft(targets_freq, n=witnesses_t.size)
     targets_t *= 1e-14  # scale
 
-    return targets_t.real, witnesses_t.real
+    return targets_t, witnesses_t
+
+
+@array_cache(_cache_bytes)
+def transfer_function(N, fs, w0, Q, gain=(1.0,)):
+    '''
+    Summed transfer function of a bank of modes on the `rfft` frequency
+    grid of an `N`-sample series, as applied by `witness`.
+
+    Each mode is ``gain / (w0**2 - x**2 + 1j w0 x / Q)`` at
+    ``x = f / (2 pi)``. `w0`, `Q` and `gain` are tuples of equal length
+    so results can be cached; the returned array is read-only. The cache
+    holds at most `_cache_bytes` of transfer functions, and is emptied
+    with ``transfer_function.cache_clear()``.
+    '''
+    x = np.fft.rfftfreq(N, d=1 / fs) / (2 * np.pi)
+    w0 = np.asarray(w0)
+    Q = np.asarray(Q)
+    gain = np.asarray(gain)
+
+    tf = np.zeros(x.size, dtype=np.complex128)
+    step = max(1, _max_elements // x.size)
+    for start in range(0, w0.size, step):
+        w = w0[start:start + step, np.newaxis]
+        q = Q[start:start + step, np.newaxis]
+        g = gain[start:start + step, np.newaxis]
+        tf += np.sum(g / (w**2 - x**2 + 1j * w * x / q), axis=0)
+
+    tf.flags.writeable = False
+    return tf
+
+
+def _resonator_sos(fs, w0, Q):
+    '''
+    IIR filter approximating the transfer function applied by `witness`.
+
+    `witness` evaluates 1 / (w0**2 - x**2 + 1j w0 x / Q) at x = f / (2 pi),
+    which is a resonator at 2 pi w0 rad/s in terms of s = 2 pi 1j f.
+    '''
+    a = (2 * np.pi)**2
+    w_res = a * w0
+    f_res = w_res / (2 * np.pi)
+    peak = a**2 * Q / w_res**2
+    if f_res < 0.45 * fs:
+        # Prewarp both band edges so the digital peak keeps its width
+        f_lo = f_res * (1 - 1 / (2 * Q))
+        f_hi = min(f_res * (1 + 1 / (2 * Q)), 0.49 * fs)
+        w_lo = 2 * fs * np.tan(np.pi * f_lo / fs)
+        w_hi = 2 * fs * np.tan(np.pi * f_hi / fs)
+        w_res = np.sqrt(w_lo * w_hi)
+        Q = w_res / (w_hi - w_lo)
+
+    root = np.sqrt(1 - 1 / (4 * Q**2) + 0j)
+    poles = w_res * np.array([[-1 / (2 * Q) + 1j * root,
+                               -1 / (2 * Q) - 1j * root]])
+    return zpk_bilinear_bank(np.empty((1, 0)), poles,
+                             peak * w_res**2 / Q, fs)[0]
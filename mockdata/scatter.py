@@ -2,72 +2,154 @@ from __future__ import division
 import numpy as np
 import scipy.signal as sig
 
+from .sinusoids import sinusoids
+from .utils import apply_filter, native_rate, resample
+
 # Function defaults
 sec_d = 16
 fs_d = 2048
 
 __all__ = ['coupling_func', 'witness']
 
+# Size budget (channels x samples) of each block of irrelevant channels
+# filtered at once
+_block_elements = 2**22
+
 # this is the laser wavelength. We need it so that the calibrated witness
 # channels make sense; the scattering fringing cares about the ratio of the
 # size motion to the wavelength
 lambduh = 1064e-9
 
 
-def coupling_func(y1, y2, scale=3e-18, phi=0):
-    return scale*np.sin(2*2*np.pi/lambduh*(y1 + y2) + phi)
+def coupling_func(y1, y2, scale=3e-18, phi=0, out=None):
+    '''
+    Scattered light noise ``scale*sin(4 pi/lambda*(y1 + y2) + phi)`` of the
+    slow motion `y1` and the acoustic motion `y2`, computed in place in
+    `out` if given (which may be `y1` or `y2` itself).
+    '''
+    out = np.add(y1, y2, out=out)
+    np.multiply(2*2*np.pi/lambduh, out, out=out)
+    if phi != 0:
+        out += phi
+    np.sin(out, out=out)
+    return np.multiply(scale, out, out=out)
 
 
 def witness(n_relevant, n_irrelevant, sec=sec_d, fs=fs_d, seed=None, rand_phase=False,
-            filt_seismic=False):
+            filt_seismic=False, noise_amp=0, distinct_irrelevant=False,
+            views=False, native_fs=None):
     '''
     Deterministically generate mock witness channel data for use
     in testing subtraction algorithms.
+
+    Half of the relevant (rounded up) and irrelevant witnesses are seismic
+    channels, the rest acoustic ones. The witness matrix is allocated once
+    and filled in place. Without sensing noise the seismic witnesses are
+    identical copies, unless `distinct_irrelevant` is set, in which case
+    every irrelevant seismic channel is its own realization; these are
+    drawn and filtered in blocks of channels, so thousands of them only
+    need a block of scratch memory.
+
+    `noise_amp` is the scale of the sensing noise added to the seismic
+    witnesses (each scaled again by a random factor in [0.1, 1)); at the
+    default of 0 no noise is drawn at all. With `views`, the witnesses
+    are returned as a list of rows in which identical channels are the
+    same read-only array, rather than as a matrix.
+
+    `native_fs` is the rate the seismic channels are generated and
+    filtered at before being upsampled to `fs` for the coupling and the
+    output. ``'auto'`` picks `utils.native_rate` of the 5 Hz band edge;
+    the default of ``None`` works at `fs` throughout. A lower native rate
+    makes a different realization for the same seed, with the same
+    spectrum up to the native Nyquist frequency.
     '''
     if isinstance(seed, np.random.RandomState):
         state = seed
     else:
         state = np.random.RandomState(seed)
 
-    nyq = fs / 2.0
-    times = np.linspace(0, sec, fs*sec, endpoint=False)
+    N = sec*fs
+    if native_fs == 'auto':
+        native_fs = native_rate(5, fs)
+    rate = fs if native_fs is None else min(native_fs, fs)
+    # Keeps the white noise ASD of the full rate draws
+    wscale = 5e-7*np.sqrt(rate / fs)
+
+    def seismic(n_chan=None):
+        white = state.randn(sec*rate) if n_chan is None else \
+            state.randn(n_chan, sec*rate)
+        y = wscale*apply_filter(band, white)
+        if(filt_seismic):
+            return y, resample(apply_filter(lowpass, y), rate, fs)
+        return y, None
 
     # Let's make this the 'seismic' channel with the low frequency stuff
-    y1     = state.randn(sec*fs)
-    b1, a1 = sig.butter(2, [0.1 / nyq, 5 / nyq], btype='bandpass')
-    y1     = sig.lfilter(b1, a1, y1)
-    y1    *= 5e-7    # this puts it into units of meters
-    y1_imit = 5e-7*sig.lfilter(b1, a1, state.randn(sec*fs))
-    if(filt_seismic):
-        b_lp, a_lp = sig.butter(1, 1.1/nyq, btype='lowpass')
-        y1_given = sig.lfilter(b_lp, a_lp, y1)
-        y1_irr = sig.lfilter(b_lp, a_lp, y1_imit)
-    else:
+    band, lowpass = _seismic_filters(rate)
+    y1, y1_given = seismic()
+    y1_imit, y1_irr = seismic()
+    y1     = resample(y1, rate, fs)  # in meters
+    y1_imit = resample(y1_imit, rate, fs)
+    if(not filt_seismic):
         y1_given = y1
         y1_irr = y1_imit
 
     # make several witnesses as requested
     rel_1 = (n_relevant+1)//2
     irrel_1 = (n_irrelevant+1)//2
-    rel_1_wits = np.tile(y1_given, (rel_1, 1))
-    irrel_1_wits = np.tile(y1_irr, (irrel_1, 1))
-    wits_1 = np.concatenate((rel_1_wits, irrel_1_wits),0)
-    # add different random noise to witnesses
-    noise_add1 = 0.0*5e-11*state.randn(rel_1+irrel_1, sec*fs)
-    noise_add1 *= state.uniform(low=0.1, high=1.0, size=(rel_1+irrel_1, 1))
-    wits_1 += noise_add1
+    rel_2 = n_relevant//2
+    irrel_2 = n_irrelevant//2
+    n_seis = rel_1 + irrel_1
+    if views:
+        wits = [None] * (n_seis + rel_2 + irrel_2)
+    else:
+        wits = np.empty((n_seis + rel_2 + irrel_2, N))
+
+    if noise_amp == 0:
+        if views:
+            wits[:rel_1] = [_readonly(y1_given)] * rel_1
+            wits[rel_1:n_seis] = [_readonly(y1_irr)] * irrel_1
+        else:
+            wits[:rel_1] = y1_given
+            wits[rel_1:n_seis] = y1_irr
+    elif views:
+        # Sensing noise is added to these in place, so each needs its own
+        for ii in range(rel_1):
+            wits[ii] = y1_given.copy()
+        for ii in range(rel_1, n_seis):
+            wits[ii] = y1_irr.copy()
+    else:
+        wits[:rel_1] = y1_given
+        wits[rel_1:n_seis] = y1_irr
+
+    if distinct_irrelevant and irrel_1 > 1:
+        # Every irrelevant seismic channel but the first is a new draw
+        step = max(1, _block_elements // N)
+        for start in range(rel_1 + 1, n_seis, step):
+            stop = min(start + step, n_seis)
+            block, filtered = seismic(stop - start)
+            block = resample(block, rate, fs) if filtered is None \
+                else filtered
+            # Sensing noise is added to these rows below, so they are only
+            # made read-only when there is none
+            for ii, row in enumerate(block, start):
+                wits[ii] = _readonly(row) if views and noise_amp == 0 \
+                    else row
+
+    if noise_amp != 0:
+        # add different random noise to witnesses
+        scale = noise_amp*state.uniform(low=0.1, high=1.0, size=n_seis)
+        for ii in range(n_seis):
+            wits[ii] += scale[ii]*state.randn(N)
 
     # this is the acoustic channel so it has only high frequency noise
     f1 = 59.5
     f2 = 119.7
     phase1 = 0.8
     phase2 = 0.32
-    y2 =  1   * np.sin(2*np.pi * (f1 * times + phase1))  # a couple of sine waves
-    y2 += 0.3 * np.sin(2*np.pi * (f2 * times + phase2))
-    y2 *= 1e-7       #  this puts it into units of meters
+    # a couple of sine waves, 1e-7 puts it into units of meters
+    y2 = sinusoids(N, fs, [f1, f2], amps=[1e-7, 0.3e-7],
+                   phases=[2*np.pi*phase1, 2*np.pi*phase2])
 
-    rel_2 = n_relevant//2
-    irrel_2 = n_irrelevant//2
     if(rand_phase):
         phase1_wit = 2*np.pi*state.uniform(size=(rel_2, 1))
         phase2_wit = 2*np.pi*state.uniform(size=(rel_2, 1))
@@ -75,16 +157,55 @@ def witness(n_relevant, n_irrelevant, sec=sec_d, fs=fs_d, seed=None, rand_phase=
         phase1_wit = np.zeros((rel_2, 1))
         phase2_wit = np.zeros((rel_2, 1))
 
-    rel_2_wits = 1e-7*np.sin(2*np.pi*f1*times + phase1 + phase1_wit) + \
-                 3e-8*np.sin(2*np.pi*f2*times + phase2 + phase2_wit)
-
     f1_irr = 71.2
     f2_irr = 143.0
     phase1_irr = 2*np.pi*state.uniform(size=(irrel_2, 1))
     phase2_irr = 2*np.pi*state.uniform(size=(irrel_2, 1))
-    irrel_2_wits = 1e-7*np.sin(2*np.pi*f1_irr*times + phase1_irr) + \
-                   3e-8*np.sin(2*np.pi*f2_irr*times + phase2_irr)
-    wits_2 = np.concatenate((rel_2_wits, irrel_2_wits), 0)
-    wits = np.concatenate((wits_1, wits_2), 0)
+
+    # acoustic witnesses are rendered straight into their rows
+    if views:
+        wits_2 = np.empty((rel_2 + irrel_2, N))
+    else:
+        wits_2 = wits[n_seis:]
+    _sine_wits(N, fs, f1, f2, phase1 + phase1_wit, phase2 + phase2_wit,
+               out=wits_2[:rel_2])
+    _sine_wits(N, fs, f1_irr, f2_irr, phase1_irr, phase2_irr,
+               out=wits_2[rel_2:])
+    if views:
+        wits[n_seis:] = list(wits_2)
 
     return y1, y2, wits
+
+
+def _readonly(arr):
+    '''
+    Read-only view of an array.
+    '''
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+
+def _seismic_filters(fs):
+    '''
+    Seismic band shaping filter, and the optional witness low-pass, as
+    (b, a) pairs.
+    '''
+    nyq = fs / 2.0
+    band = sig.butter(2, [0.1 / nyq, 5 / nyq], btype='bandpass')
+    lowpass = sig.butter(1, 1.1/nyq, btype='lowpass')
+    return band, lowpass
+
+
+def _sine_wits(n, fs, f1, f2, phase1, phase2, t0=0, out=None):
+    '''
+    Acoustic witnesses with two sine waves each, one row per phase pair,
+    starting at time `t0`.
+    '''
+    phases = np.concatenate((np.ravel(phase1), np.ravel(phase2)))
+    rows = phases.size // 2
+    if out is None:
+        out = np.empty((rows, n))
+    return sinusoids(n, fs, [f1]*rows + [f2]*rows,
+                     amps=[1e-7]*rows + [3e-8]*rows,
+                     phases=phases, t0=t0, out=out)
@@ -0,0 +1,218 @@
+from __future__ import division
+import numpy as np
+import scipy.signal as sig
+
+__all__ = ['score_estimates', 'format_scores', 'score_bands_d']
+
+# Bands the scores are given for, in Hz
+score_bands_d = [(10, 30), (30, 100), (100, 300), (300, 1000)]
+
+# Budget in bytes for the segment spectra held at once
+_block_bytes = 2**28
+
+
+def score_estimates(target, background, estimates, fs=2048, tfft=8,
+                    bands=None, ideal=None, names=None, worse_factor=1.1,
+                    return_psd=False):
+    '''
+    Score a stack of candidate estimates of the coupled noise against the
+    same target and background, in one batched spectral pass.
+
+    PSDs are Welch averages like those of `plots.plot_asd` (Hann windows
+    of `tfft` seconds with 50% overlap, means removed). As the segment
+    spectra are linear, the target, background and ideal estimate are
+    transformed once, and the residual and mismatch spectra of all
+    estimates are differences of those and one batched transform of the
+    estimates. Segments are processed in blocks, so the memory needed
+    does not grow with the length of the data.
+
+    Parameters
+    ----------
+    target, background : array_like, shape (N,)
+        Subtraction target and background, as from `starting_data`.
+    estimates : array_like, shape (K, N), or dict
+        Candidate estimates, one per row, or a dict of them by name.
+    fs : float
+        Sampling frequency in Hz. Defaults to 2048 Hz.
+    tfft : float
+        Welch segment length in seconds. Defaults to 8 s.
+    bands : list of (float, float), optional
+        Frequency bands in Hz to score. Bands above 80% of Nyquist are
+        cut or dropped. Defaults to `score_bands_d`.
+    ideal : array_like, shape (N,), optional
+        Ideal estimate to measure the mismatch against, such as
+        ``aux['ideal_estimate']``. Defaults to ``target - background``,
+        the noise that was actually added.
+    names : list of str, optional
+        Names of the estimates. Defaults to the dict keys, or their
+        indices.
+    worse_factor : float
+        A frequency bin is counted as worse if the residual PSD is over
+        `worse_factor` times the target PSD. Defaults to 1.1.
+    return_psd : bool
+        Also return the frequencies and PSDs. Defaults to False.
+
+    Returns
+    -------
+    table : recarray, shape (K,)
+        One row per estimate, with its 'name', and per band ``lo_hi``:
+
+          - 'ratio_lo_hi', the band RMS of the target over that of the
+            residual; above 1 the estimate removes noise,
+          - 'excess_lo_hi', the band RMS of the residual over that of the
+            background; 1 is perfect subtraction,
+          - 'mismatch_lo_hi', the band RMS of ``estimate - ideal`` over
+            that of the ideal estimate,
+
+        and 'worse', the number of bins in the bands where the residual
+        PSD is over `worse_factor` times the target PSD.
+    freqs : ndarray
+        Frequencies, if `return_psd`.
+    psd : dict
+        With `return_psd`, the 'target', 'background' and 'ideal' PSDs,
+        and the 'residual' and 'mismatch' PSDs of shape (K, freqs).
+    '''
+    if isinstance(estimates, dict):
+        if names is None:
+            names = list(estimates)
+        estimates = [estimates[name] for name in names]
+    estimates = np.atleast_2d(estimates)
+    target = np.asarray(target)
+    background = np.asarray(background)
+    K, N = estimates.shape
+    if target.shape != (N,) or background.shape != (N,):
+        raise ValueError('Target, background and estimates must have the '
+                         'same length')
+    if names is None:
+        names = [str(k) for k in range(K)]
+    if len(names) != K:
+        raise ValueError('Got {} names for {} estimates'.format(len(names),
+                                                                K))
+
+    L = int(tfft * fs)
+    if L > N:
+        raise ValueError('Data are shorter than one segment')
+    # The step of `scipy.signal.welch`, whose overlap is L // 2
+    step = L - L // 2
+    n_seg = 1 + (N - L) // step
+    freqs = np.fft.rfftfreq(L, d=1 / fs)
+    window = sig.get_window('hann', L)
+
+    fmax = 0.8 * fs / 2
+    if bands is None:
+        bands = score_bands_d
+    bands = [(lo, min(hi, fmax)) for lo, hi in bands if lo < fmax]
+    if not bands:
+        raise ValueError('No bands below 80% of Nyquist')
+
+    F = freqs.size
+    sums = {name: np.zeros(F) for name in ('target', 'background', 'ideal')}
+    res_sum = np.zeros((K, F))
+    mis_sum = np.zeros((K, F))
+
+    # Segment spectra of the estimates, plus temporaries, in the budget
+    block = max(1, _block_bytes // (3 * 16 * F * (K + 3)))
+    for first in range(0, n_seg, block):
+        segs = range(first, min(first + block, n_seg))
+        T = _segment_spectra(target, segs, step, window)
+        B = _segment_spectra(background, segs, step, window)
+        if ideal is None:
+            I = T - B
+        else:
+            I = _segment_spectra(ideal, segs, step, window)
+        E = _segment_spectra(estimates, segs, step, window)
+
+        sums['target'] += _power(T).sum(0)
+        sums['background'] += _power(B).sum(0)
+        sums['ideal'] += _power(I).sum(0)
+        mis_sum += _power(E - I).sum(1)
+        np.subtract(T, E, out=E)
+        res_sum += _power(E).sum(1)
+        del T, B, I, E
+
+    # One-sided density scaling, as `scipy.signal.welch`
+    scale = np.full(F, 2 / (fs * np.sum(window**2) * n_seg))
+    scale[0] /= 2
+    if L % 2 == 0:
+        scale[-1] /= 2
+    psd = {name: total * scale for name, total in sums.items()}
+    psd['residual'] = res_sum * scale
+    psd['mismatch'] = mis_sum * scale
+
+    table = np.zeros(K, dtype=_score_dtype(bands, names)).view(np.recarray)
+    table['name'] = names
+    scored = np.zeros(F, dtype=bool)
+    for lo, hi in bands:
+        inband = (freqs >= lo) & (freqs < hi)
+        scored |= inband
+        label = _band_label(lo, hi)
+        tar = psd['target'][inband].sum()
+        res = psd['residual'][:, inband].sum(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table['ratio_' + label] = np.sqrt(tar / res)
+            table['excess_' + label] = np.sqrt(
+                res / psd['background'][inband].sum())
+            table['mismatch_' + label] = np.sqrt(
+                psd['mismatch'][:, inband].sum(1) /
+                psd['ideal'][inband].sum())
+    table['worse'] = np.sum(psd['residual'][:, scored] >
+                            worse_factor * psd['target'][scored], axis=1)
+
+    if return_psd:
+        return table, freqs, psd
+    return table
+
+
+def format_scores(table, sort=None):
+    '''
+    Text table of the scores from `score_estimates`, optionally sorted by
+    a field, best first for 'ratio' fields and lowest first otherwise.
+    '''
+    if sort is not None:
+        order = np.argsort(table[sort])
+        if sort.startswith('ratio'):
+            order = order[::-1]
+        table = table[order]
+    fields = table.dtype.names[1:]
+    widths = [max(len(name), 9) for name in fields]
+    name_width = max([4] + [len(name) for name in table['name']])
+    lines = ['{:<{}} '.format('name', name_width) +
+             ' '.join('{:>{}}'.format(name, width)
+                      for name, width in zip(fields, widths))]
+    for row in table:
+        values = ['{:>{}{}}'.format(row[name], width,
+                                    'd' if name == 'worse' else '.3g')
+                  for name, width in zip(fields, widths)]
+        lines.append('{:<{}} '.format(row['name'], name_width) +
+                     ' '.join(values))
+    return '\n'.join(lines)
+
+
+def _segment_spectra(x, segs, step, window):
+    '''
+    Spectra of the Welch segments `segs` of `x` along its last axis, with
+    the means removed and the window applied.
+    '''
+    L = window.size
+    frames = np.stack([np.asarray(x[..., s * step:s * step + L], dtype=float)
+                       for s in segs], axis=-2)
+    frames -= frames.mean(axis=-1, keepdims=True)
+    frames *= window
+    return np.fft.rfft(frames, axis=-1)
+
+
+def _power(spectra):
+    return spectra.real**2 + spectra.imag**2
+
+
+def _band_label(lo, hi):
+    return '{:g}_{:g}'.format(lo, hi).replace('.', 'p')
+
+
+def _score_dtype(bands, names):
+    fields = [('name', 'U{}'.format(max([1] + [len(n) for n in names])))]
+    for kind in ('ratio', 'excess', 'mismatch'):
+        fields += [('{}_{}'.format(kind, _band_label(lo, hi)), float)
+                   for lo, hi in bands]
+    fields.append(('worse', int))
+    return np.dtype(fields)
@@ -0,0 +1,427 @@
+from __future__ import division
+import hashlib
+import json
+import numbers
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+from .mock_noise import starting_data, known_models, _model_parser
+from .mock_noise import sec_d, fs_d
+from .timeaxis import TimeAxis
+
+__all__ = ['GenerationService', 'QueueFull', 'serve', 'served_starting_data']
+
+default_port = 8765
+default_cache = os.path.join(os.path.expanduser('~'), '.cache',
+                             'mockdata')
+
+# Bumped whenever the layout of cache entries changes
+_cache_version = 1
+
+
+class QueueFull(Exception):
+    '''
+    Raised when a `GenerationService` has no room for another job.
+    '''
+
+
+class GenerationService(object):
+    '''
+    Queue of `starting_data` jobs run on a warm worker pool, with results
+    kept in a deduplicating on-disk cache.
+
+    A job is identified by a hash of its (model, sec, fs, seed, parse_str),
+    so asking again for data that is cached, queued or being generated
+    returns the existing job instead of generating it twice. Each cache
+    entry is a directory holding one '.npy' file per array and a
+    'meta.json'; entries are written to a temporary directory and renamed
+    into place, so an entry that exists is complete, even if several
+    services share the cache. Readers memory-map the files.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the result cache. Created if needed.
+    workers : int
+        Number of worker processes (or threads). Defaults to 2.
+    max_queue : int
+        Maximum number of jobs queued or running at once. Further
+        submissions are refused until some finish. Defaults to 16.
+    backend : {'process', 'thread'}
+        Kind of worker pool. Defaults to 'process'.
+    '''
+    def __init__(self, cache_dir=default_cache, workers=2, max_queue=16,
+                 backend='process'):
+        if backend not in ('thread', 'process'):
+            raise ValueError('Unknown backend: {}'.format(backend))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_queue = max_queue
+
+        if backend == 'process':
+            self._pool = ProcessPoolExecutor(workers)
+        else:
+            self._pool = ThreadPoolExecutor(workers)
+        # Start the workers and pay the import cost up front
+        for future in [self._pool.submit(_warm) for _ in range(workers)]:
+            future.result()
+
+        self._lock = threading.RLock()
+        self._jobs = {}  # unfinished or failed jobs by key
+
+    def submit(self, model='scatter', sec=sec_d, fs=fs_d, seed=None,
+               parse_str=''):
+        '''
+        Queue a generation job, unless the same one is cached or queued.
+
+        Returns the job's status, as for `status`. Raises `QueueFull` if
+        `max_queue` jobs are already waiting or running.
+        '''
+        request = _normalize(model, sec, fs, seed, parse_str)
+        key = _job_key(request)
+
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job['future'] is not None:
+                return self._job_status(key, job)
+            if os.path.isfile(self._meta_path(key)):
+                return self._entry_status(key)
+
+            active = sum(1 for j in self._jobs.values()
+                         if j['future'] is not None)
+            if active >= self.max_queue:
+                raise QueueFull('{} jobs already queued'.format(active))
+
+            future = self._pool.submit(_generate_entry, self.cache_dir, key,
+                                       request)
+            self._jobs[key] = {'request': request, 'future': future,
+                               'submitted': time.time()}
+            future.add_done_callback(lambda f, key=key: self._done(key, f))
+            return self._job_status(key, self._jobs.get(key))
+
+    def status(self, key):
+        '''
+        Status of job `key` as a dict. 'status' is one of 'queued',
+        'running', 'done', 'failed' or 'unknown'; done jobs also list the
+        cached 'files' and the entry's metadata.
+        '''
+        job = self._jobs.get(key)
+        if job is not None:
+            return self._job_status(key, job)
+        return self._entry_status(key)
+
+    def _entry_status(self, key):
+        try:
+            with open(self._meta_path(key)) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'id': key, 'status': 'unknown'}
+
+        entry = os.path.join(self.cache_dir, key)
+        meta.update({
+            'id': key,
+            'status': 'done',
+            'files': {name: os.path.join(entry, fname)
+                      for name, fname in meta['files'].items()},
+        })
+        return meta
+
+    def stats(self):
+        '''
+        Counts of the jobs by status and of the cache entries.
+        '''
+        counts = {'queued': 0, 'running': 0, 'failed': 0}
+        with self._lock:
+            for key, job in self._jobs.items():
+                counts[self._job_status(key, job)['status']] += 1
+        counts['cached'] = sum(
+            1 for name in os.listdir(self.cache_dir)
+            if os.path.isfile(self._meta_path(name)))
+        counts['workers'] = self.workers
+        counts['max_queue'] = self.max_queue
+        return counts
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, key, 'meta.json')
+
+    def _job_status(self, key, job):
+        if job['future'] is None:
+            return {'id': key, 'status': 'failed', 'error': job['error'],
+                    'request': job['request']}
+        if job['future'].done():
+            # Finished, but the done callback has not run yet
+            error = job['future'].exception()
+            if error is None:
+                return self._entry_status(key)
+            return {'id': key, 'status': 'failed', 'error': repr(error),
+                    'request': job['request']}
+        state = 'running' if job['future'].running() else 'queued'
+        return {'id': key, 'status': state, 'request': job['request']}
+
+    def _done(self, key, future):
+        with self._lock:
+            error = future.exception()
+            if error is None:
+                del self._jobs[key]
+            else:
+                self._jobs[key] = {'request': self._jobs[key]['request'],
+                                   'future': None, 'error': repr(error)}
+
+
+def _job_key(request):
+    '''
+    Cache key of a normalized request.
+    '''
+    blob = json.dumps([_cache_version, request], sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()[:20]
+
+
+def _normalize(model, sec, fs, seed, parse_str):
+    '''
+    Check a request and put it in canonical form. A seed of ``None`` is
+    replaced by a random one, so the request still has a single result.
+    '''
+    if model not in known_models:
+        raise ValueError('Unknown noise model type: {}'.format(model))
+    if seed is None:
+        seed = int(np.random.randint(2**31 - 1))
+    if isinstance(seed, bool) or not isinstance(seed, numbers.Integral):
+        raise TypeError('Served data needs an integer seed, got {!r}'
+                        .format(seed))
+    if isinstance(parse_str, str):
+        parse_str = parse_str.split()
+    parse_str = [str(word) for word in parse_str]
+    try:
+        _model_parser(model).parse_args(parse_str)
+    except SystemExit:
+        raise ValueError('Invalid keywords for model {}: {}'.format(
+            model, ' '.join(parse_str)))
+    sec = _canonical_number(sec)
+    fs = _canonical_number(fs)
+    if sec <= 0 or fs <= 0:
+        raise ValueError('sec and fs must be positive')
+
+    return {'model': model, 'sec': sec, 'fs': fs, 'seed': int(seed),
+            'parse_str': parse_str}
+
+
+def _canonical_number(value):
+    '''
+    `value` as a float, or as an int if it is whole, so that equal values
+    given as 16, 16.0 or '16' make the same request key.
+    '''
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _warm():
+    return os.getpid()
+
+
+def _generate_entry(cache_dir, key, request):
+    '''
+    Generate the data of `request` into the cache entry `key`.
+    '''
+    entry = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(entry, 'meta.json')):
+        return entry
+
+    start = time.time()
+    times, background, target, witnesses, aux = starting_data(
+        sec=request['sec'], fs=request['fs'], model=request['model'],
+        seed=request['seed'], parse_str=request['parse_str'])
+
+    arrays = {'background': background, 'target': target,
+              'witnesses': witnesses}
+    scalars = {}
+    for name in aux:
+        value = np.asarray(aux[name])
+        if value.ndim == 0:
+            scalars[name] = value.item()
+        else:
+            arrays['aux_' + name] = value
+
+    tmp = tempfile.mkdtemp(prefix='.tmp-' + key, dir=cache_dir)
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), arr)
+        meta = {
+            'request': request,
+            't0': times.t0,
+            'fs': times.fs,
+            'n': times.n,
+            'files': {name: name + '.npy' for name in arrays},
+            'aux': sorted(name for name in aux),
+            'aux_scalars': scalars,
+            'elapsed': time.time() - start,
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Someone else finished the same entry first
+            if not os.path.isfile(os.path.join(entry, 'meta.json')):
+                raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+    return entry
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''
+    JSON over HTTP front end of a `GenerationService`:
+
+      - ``POST /jobs`` with a JSON request queues a job,
+      - ``GET /jobs/<id>`` gives its status,
+      - ``GET /stats`` gives the job and cache counts.
+    '''
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            status = self.server.service.submit(**body)
+        except QueueFull as e:
+            return self._reply(503, {'error': str(e)})
+        except (TypeError, ValueError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(200 if status['status'] == 'done' else 202, status)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['stats']:
+            return self._reply(200, self.server.service.stats())
+        if len(parts) == 2 and parts[0] == 'jobs':
+            status = self.server.service.status(parts[1])
+            code = 404 if status['status'] == 'unknown' else 200
+            return self._reply(code, status)
+        self._reply(404, {'error': 'Not found'})
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+def serve(host='127.0.0.1', port=default_port, cache_dir=default_cache,
+          workers=2, max_queue=16, backend='process', quiet=False):
+    '''
+    Run a `GenerationService` behind a local HTTP server until
+    interrupted. See `served_starting_data` for the client side.
+    '''
+    service = GenerationService(cache_dir, workers=workers,
+                                max_queue=max_queue, backend=backend)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    server.quiet = quiet
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def served_starting_data(sec=sec_d, fs=fs_d, model='scatter', seed=None,
+                         parse_str='', address=None, timeout=None,
+                         poll=0.25):
+    '''
+    Same as `starting_data`, but generated by (or fetched from the cache
+    of) a local service started with ``python -m mockdata serve``.
+
+    The arrays are read-only memory maps of the cached files, so several
+    processes using the same data share one copy in the page cache. The
+    service must run on the same machine, as the files are read directly.
+
+    Parameters
+    ----------
+    sec, fs, model, seed, parse_str
+        As for `starting_data`. `seed` must be an integer or ``None``.
+    address : str, optional
+        Base URL of the service. Defaults to the default local port.
+    timeout : float, optional
+        Seconds to wait for the job before raising `TimeoutError`. Waits
+        indefinitely by default.
+    poll : float
+        Seconds between status requests while the job runs.
+
+    Returns
+    -------
+    times, background, target, witnesses, aux
+        As for `starting_data`, with aux a dict.
+    '''
+    if address is None:
+        address = 'http://127.0.0.1:{}'.format(default_port)
+    address = address.rstrip('/')
+    if isinstance(parse_str, str):
+        parse_str = parse_str.split()
+
+    status = _call(address + '/jobs', {'model': model, 'sec': sec, 'fs': fs,
+                                       'seed': seed,
+                                       'parse_str': list(parse_str)})
+    start = time.time()
+    while status['status'] in ('queued', 'running'):
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError('Job {} not done after {} s'.format(
+                status['id'], timeout))
+        time.sleep(poll)
+        status = _call(address + '/jobs/' + status['id'])
+    if status['status'] != 'done':
+        raise RuntimeError('Job {} failed: {}'.format(
+            status['id'], status.get('error')))
+
+    files = status['files']
+    arrays = {name: np.load(path, mmap_mode='r')
+              for name, path in files.items()}
+    aux = dict(status['aux_scalars'])
+    for name in status['aux']:
+        if 'aux_' + name in arrays:
+            aux[name] = arrays['aux_' + name]
+    times = TimeAxis(status['n'], status['fs'], status['t0'])
+    return (times, arrays['background'], arrays['target'],
+            arrays['witnesses'], aux)
+
+
+def _call(url, payload=None):
+    '''
+    JSON request to the service; POST if there is a payload.
+    '''
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    request = Request(url, data=data,
+                      headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        try:
+            message = json.loads(e.read().decode('utf-8'))['error']
+        except (ValueError, KeyError):
+            message = str(e)
+        if e.code == 503:
+            raise RuntimeError('Service queue is full: {}'.format(message))
+        raise ValueError(message)
@@ -0,0 +1,156 @@
+from __future__ import division
+import numpy as np
+
+__all__ = ['SinusoidBank', 'sinusoids']
+
+# Size budget (lines x samples) of the per-block complex work arrays
+_block_elements = 2**20
+
+
+class SinusoidBank(object):
+    '''
+    Phase-continuous synthesis of many sinusoids, amps * sin(w t + phases).
+
+    Rather than calling `np.sin` for every sample of every line, each line
+    keeps a unit phasor that is advanced by a complex rotation. Within a
+    block the rotations come from a table of exp(1j w n) computed once, so
+    summing lines costs two matrix-vector products per block. The phasors
+    are renormalized after every block, so errors do not build up over long
+    series.
+
+    Successive calls to `render` continue where the last one stopped.
+
+    Parameters
+    ----------
+    freqs : array_like, shape (n,)
+        Frequencies of the lines in Hz.
+    fs : float
+        Sampling frequency in Hz.
+    amps : array_like
+        Amplitude of each line. Defaults to 1.
+    phases : array_like
+        Phase of each line in radians at time `t0`. Defaults to 0.
+    t0 : float
+        Time of the first rendered sample, in seconds. Defaults to 0.
+    block : int, optional
+        Samples per block. Defaults to as many as fit the work array budget,
+        up to 4096.
+    '''
+    def __init__(self, freqs, fs, amps=1, phases=0, t0=0, block=None):
+        freqs, amps, phases = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(freqs, dtype=float)),
+            np.atleast_1d(np.asarray(amps, dtype=float)),
+            np.atleast_1d(np.asarray(phases, dtype=float)))
+
+        self.fs = fs
+        self.freqs = freqs
+        self.amps = amps.copy()
+        self.omega = 2 * np.pi * freqs / fs  # rad/sample
+
+        if block is None:
+            block = int(np.clip(_block_elements // max(freqs.size, 1),
+                                64, 4096))
+        self.block = block
+
+        self._phasor = np.exp(1j * (2 * np.pi * freqs * t0 + phases))
+        table = np.exp(1j * self.omega[:, np.newaxis] * np.arange(block))
+        self._table = table
+        self._table_re = np.ascontiguousarray(table.real)
+        self._table_im = np.ascontiguousarray(table.imag)
+        self._advance = np.exp(1j * self.omega * block)
+
+    def render(self, out, add=False, freq_offset=None):
+        '''
+        Synthesize the next ``out.shape[-1]`` samples into `out`.
+
+        If `out` is 1-D, all lines are summed into it. If it is 2-D with
+        `m` rows, the number of lines must be a multiple of `m`, and line
+        ``i`` goes to row ``i % m``.
+
+        Parameters
+        ----------
+        out : ndarray, shape (N,) or (m, N)
+            Preallocated output buffer.
+        add : bool
+            If True, add to the contents of `out` instead of overwriting
+            them. Defaults to False.
+        freq_offset : array_like, shape (n,), optional
+            Frequency offset in Hz held for the duration of this call, e.g.
+            for slowly wandering lines. Phase stays continuous.
+
+        Returns
+        -------
+        out : ndarray
+        '''
+        n_lines = self.freqs.size
+        if n_lines == 0:
+            if not add:
+                out[...] = 0
+            return out
+        if out.ndim == 1:
+            n_rows = 1
+        else:
+            n_rows = out.shape[0]
+            if n_lines % n_rows:
+                raise ValueError('Number of lines must be a multiple of the '
+                                 'number of output rows')
+
+        if freq_offset is None:
+            table = self._table
+            table_re = self._table_re
+            table_im = self._table_im
+            advance = self._advance
+        else:
+            omega = self.omega + 2 * np.pi * np.asarray(freq_offset) / self.fs
+            step = np.exp(1j * omega)
+            table = np.empty((n_lines, self.block), dtype=complex)
+            table[:, 0] = 1
+            table[:, 1:] = step[:, np.newaxis]
+            np.cumprod(table, axis=1, out=table)
+            table_re = np.ascontiguousarray(table.real)
+            table_im = np.ascontiguousarray(table.imag)
+            advance = np.exp(1j * omega * self.block)
+
+        N = out.shape[-1]
+        for start in range(0, N, self.block):
+            stop = min(start + self.block, N)
+            nn = stop - start
+            # Im(a P T) = (a Re P) Im T + (a Im P) Re T, so summing over
+            # lines is a pair of matrix-vector products with the table
+            a_re = self.amps * self._phasor.real
+            a_im = self.amps * self._phasor.imag
+
+            if out.ndim == 1:
+                block_out = np.dot(a_re, table_im[:, :nn])
+                block_out += np.dot(a_im, table_re[:, :nn])
+            else:
+                vals = a_re[:, np.newaxis] * table_im[:, :nn]
+                vals += a_im[:, np.newaxis] * table_re[:, :nn]
+                block_out = vals.reshape(-1, n_rows, nn).sum(axis=0)
+
+            if add:
+                out[..., start:stop] += block_out
+            else:
+                out[..., start:stop] = block_out
+
+            if nn == self.block:
+                self._phasor *= advance
+            else:
+                self._phasor *= table[:, nn - 1] * table[:, 1]
+            self._phasor /= np.abs(self._phasor)
+
+        return out
+
+
+def sinusoids(n, fs, freqs, amps=1, phases=0, t0=0, out=None, add=False):
+    '''
+    Sum of sinusoids, amps * sin(2 pi freqs t + phases), over `n` samples.
+
+    Convenience wrapper around `SinusoidBank` for one-shot synthesis. Pass
+    a 2-D `out` to get one row per group of lines, see
+    `SinusoidBank.render`.
+    '''
+    if out is None:
+        out = np.zeros(n)
+    bank = SinusoidBank(freqs, fs, amps=amps, phases=phases, t0=t0)
+    return bank.render(out, add=add)
@@ -0,0 +1,318 @@
+from __future__ import division
+import itertools
+import json
+import os
+
+import numpy as np
+
+from .mock_bg import bucket_noise, get_lines
+from .mock_noise import known_models, _model_parser, sec_d, fs_d
+from .sinusoids import sinusoids
+from .timeaxis import TimeAxis
+from .utils import apply_filter
+from .lazyaux import LazyAux
+from . import scatter
+from . import bilinear
+from . import resonance
+
+__all__ = ['iter_sweep', 'save_sweep']
+
+# Model keywords that can be swept, by model
+sweep_params = {
+    'scatter': ('relevant', 'irrelevant'),
+    'bilinear': ('pairs',),
+    'resonance': ('frequency', 'quality', 'gain'),
+}
+
+# Aux entries that are the same for every point of a sweep, by model
+_shared_aux = {
+    'scatter': ('y1', 'y2'),
+}
+
+# Size budget (points x frequency bins) of batched resonance transforms
+_max_elements = 2**22
+
+
+def iter_sweep(model, grid, sec=sec_d, fs=fs_d, seed=None, parse_str=''):
+    '''
+    Generate `starting_data` style data over a grid of model parameters,
+    making the parts that don't depend on the parameters only once.
+
+    The background, and whatever else a model draws independently of the
+    swept parameters, is generated a single time; each grid point only
+    pays for its coupling:
+
+      - 'resonance' shares the white witness and applies each point's
+        transfer function, several points per batched inverse FFT,
+      - 'scatter' shares the seismic and acoustic motion, and so the
+        target, across witness counts; witness sets are nested, so a point
+        with more witnesses adds channels to those of a smaller one,
+      - 'bilinear' builds the pairs in order and emits each point as soon
+        as its number of pairs is reached.
+
+    For the same seed, the background and target match `starting_data`
+    with the point's keywords, as do the bilinear witnesses. Points may be
+    produced out of grid order; each comes with its grid index.
+
+    Parameters
+    ----------
+    model : string
+        Noise model, one of `known_models`.
+    grid : dict or sequence of dict
+        Either a dict mapping parameter names to lists of values, whose
+        product is taken, or an explicit list of parameter dicts. Names are
+        the model keyword destinations: 'frequency', 'quality' and 'gain'
+        for 'resonance' (values may be lists, for mode banks), 'relevant'
+        and 'irrelevant' for 'scatter', and 'pairs' for 'bilinear'.
+    sec, fs, seed
+        As for `starting_data`.
+    parse_str : list of str
+        Model keywords shared by all points. Swept parameters override
+        them.
+
+    Returns
+    -------
+    times : TimeAxis
+        Sample times.
+    background : ndarray
+        Background shared by all points.
+    points : generator
+        Yields ``(index, params, target, witnesses, aux)`` for each point.
+    '''
+    if model not in known_models:
+        raise ValueError('Unknown noise model type: {}'.format(model))
+
+    if isinstance(seed, np.random.RandomState):
+        state = seed
+    else:
+        state = np.random.RandomState(seed)
+
+    base = vars(_model_parser(model).parse_args(parse_str))
+    points = _grid_points(grid)
+    for params in points:
+        unknown = set(params) - set(sweep_params[model])
+        if unknown:
+            raise ValueError('Cannot sweep {} for model {}'.format(
+                ', '.join(sorted(unknown)), model))
+    args = [dict(base, **params) for params in points]
+    if base.get('native_rate'):
+        raise ValueError('Sweeps do not support native rates')
+
+    times = TimeAxis.from_seconds(sec, fs)
+    background = bucket_noise(sec, fs, seed=state)
+    background += get_lines(sec, fs, seed=state)
+
+    if model == 'scatter':
+        gen = _scatter_points(sec, fs, state, background, args)
+    elif model == 'bilinear':
+        gen = _bilinear_points(sec, fs, state, background, args)
+    else:
+        gen = _resonance_points(sec, fs, state, background, args)
+
+    def with_params():
+        for index, target, witnesses, aux in gen:
+            yield index, points[index], target, witnesses, aux
+
+    return times, background, with_params()
+
+
+def save_sweep(outdir, model, grid, sec=sec_d, fs=fs_d, seed=None,
+               parse_str='', aux_keys=None):
+    '''
+    Run `iter_sweep` and stream the results to `outdir`.
+
+    The shared background goes to 'shared.npz' (with 't0' and 'fs'),
+    together with the aux entries that are the same for every point, such
+    as the scatter motions 'y1' and 'y2'. Each point goes to
+    'point_<index>.npz' with 'target', 'witnesses' and its own aux
+    entries. 'index.json' lists the files with their parameters and the
+    names of the shared aux entries, and is rewritten after every point,
+    so an interrupted sweep stays usable. `aux_keys` limits the aux
+    entries saved, so unused ones are never computed; ``None`` saves them
+    all.
+
+    Returns
+    -------
+    index : dict
+        Contents of 'index.json'.
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    times, background, points = iter_sweep(model, grid, sec=sec, fs=fs,
+                                           seed=seed, parse_str=parse_str)
+    shared = {'background': background, 't0': times.t0, 'fs': fs}
+    shared_keys = [key for key in _shared_aux.get(model, ())
+                   if aux_keys is None or key in aux_keys]
+    del background
+
+    index = {
+        'model': model,
+        'sec': sec,
+        'fs': fs,
+        'seed': seed if np.isscalar(seed) else None,
+        'parse_str': list(parse_str),
+        'shared': 'shared.npz',
+        'shared_aux': shared_keys,
+        'points': [],
+    }
+
+    for ii, params, target, witnesses, aux in points:
+        if shared is not None:
+            # The shared aux entries come with the first point
+            shared.update((key, aux[key]) for key in shared_keys)
+            _write_shared(outdir, index, shared)
+            shared = None
+        keys = aux if aux_keys is None else \
+            [key for key in aux_keys if key in aux]
+        aux = {key: aux[key] for key in keys if key not in shared_keys}
+        name = 'point_{:04d}.npz'.format(ii)
+        np.savez(os.path.join(outdir, name), target=target,
+                 witnesses=witnesses, **aux)
+        index['points'].append({'index': ii, 'file': name,
+                                'params': params})
+        index['points'].sort(key=lambda entry: entry['index'])
+        _write_index(outdir, index)
+
+    if shared is not None:
+        index['shared_aux'] = []
+        _write_shared(outdir, index, shared)
+
+    return index
+
+
+def _write_shared(outdir, index, shared):
+    np.savez(os.path.join(outdir, index['shared']), **shared)
+    _write_index(outdir, index)
+
+
+def _write_index(outdir, index):
+    path = os.path.join(outdir, 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, default=lambda x: x.tolist())
+    os.replace(path + '.tmp', path)
+
+
+def _grid_points(grid):
+    '''
+    List of parameter dicts from a dict of value lists, or a list of dicts.
+    '''
+    if isinstance(grid, dict):
+        names = list(grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*[grid[n] for n in names])]
+    return [dict(params) for params in grid]
+
+
+def _scatter_points(sec, fs, state, background, args):
+    N = int(sec * fs)
+    if args and (args[0]['distinct_irrelevant'] or args[0]['witness_noise']):
+        raise ValueError('Scatter sweeps need identical noiseless seismic '
+                         'witnesses')
+
+    # Same draws as `scatter.witness` up to the count-dependent ones
+    band, lowpass = scatter._seismic_filters(fs)
+    y1 = 5e-7 * apply_filter(band, state.randn(N))
+    y1_imit = 5e-7 * apply_filter(band, state.randn(N))
+    filt_seismic = args[0]['filt_seismic'] if args else False
+    if filt_seismic:
+        y1_given = apply_filter(lowpass, y1)
+        y1_irr = apply_filter(lowpass, y1_imit)
+    else:
+        y1_given = y1
+        y1_irr = y1_imit
+
+    y2 = sinusoids(N, fs, [59.5, 119.7], amps=[1e-7, 0.3e-7],
+                   phases=[2*np.pi*0.8, 2*np.pi*0.32])
+    target = scatter.coupling_func(y1, y2)
+    target += background
+
+    # Acoustic witnesses for the largest counts, shared by all points
+    rel_2 = max([a['relevant'] // 2 for a in args] + [0])
+    irrel_2 = max([a['irrelevant'] // 2 for a in args] + [0])
+    if args and args[0]['random_phase']:
+        phase1_wit = 2*np.pi*state.uniform(size=rel_2)
+        phase2_wit = 2*np.pi*state.uniform(size=rel_2)
+    else:
+        phase1_wit = np.zeros(rel_2)
+        phase2_wit = np.zeros(rel_2)
+    rel_wits = scatter._sine_wits(N, fs, 59.5, 119.7, 0.8 + phase1_wit,
+                                  0.32 + phase2_wit)
+    irrel_wits = scatter._sine_wits(N, fs, 71.2, 143.0,
+                                    2*np.pi*state.uniform(size=irrel_2),
+                                    2*np.pi*state.uniform(size=irrel_2))
+
+    aux = {'y1': y1, 'y2': y2}
+    for ii, a in enumerate(args):
+        rel_1 = (a['relevant'] + 1) // 2
+        irrel_1 = (a['irrelevant'] + 1) // 2
+        witnesses = np.concatenate(
+            [np.broadcast_to(y1_given, (rel_1, N)),
+             np.broadcast_to(y1_irr, (irrel_1, N)),
+             rel_wits[:a['relevant'] // 2],
+             irrel_wits[:a['irrelevant'] // 2]], axis=0)
+        yield ii, target, witnesses, aux
+
+
+def _bilinear_points(sec, fs, state, background, args):
+    pairs = np.array([a['pairs'] for a in args])
+    if np.any(pairs < 1):
+        raise ValueError('Pairs must be a positive integer')
+
+    coupled_noise = 0
+    beam_motions = []
+    angular_controls = []
+    true_beam = []
+    true_angular = []
+
+    for p in range(1, max(pairs) + 1):
+        witness, true_motion = bilinear.witness(sec, fs, seed=state)
+
+        coupled_noise += bilinear.coupling_func(true_motion)
+
+        beam_motions.append(witness[0])
+        angular_controls.append(witness[1])
+        true_beam.append(true_motion[0])
+        true_angular.append(true_motion[1])
+
+        hits = np.flatnonzero(pairs == p)
+        if hits.size == 0:
+            continue
+        target = coupled_noise + background
+        witnesses = np.stack(beam_motions + angular_controls)
+        aux = LazyAux(Npairs=p)
+        aux.defer('true_motions',
+                  lambda t=true_beam + true_angular: np.stack(t))
+        # From the pairs' own rows, not the yielded copies
+        aux.defer('ideal_estimate',
+                  lambda rows=beam_motions + angular_controls:
+                  bilinear.ideal_estimate_pairs(rows, fs))
+        for ii in hits:
+            yield ii, target, witnesses, aux
+
+
+def _resonance_points(sec, fs, state, background, args):
+    witnesses = state.randn(int(fs * sec))
+    N = witnesses.size
+    spectrum = np.fft.rfft(witnesses)
+
+    step = max(1, _max_elements // spectrum.size)
+    for start in range(0, len(args), step):
+        batch = args[start:start + step]
+        tfs = np.empty((len(batch), spectrum.size), dtype=np.complex128)
+        for row, a in zip(tfs, batch):
+            w0, Q, gain = np.broadcast_arrays(
+                2*np.pi*np.atleast_1d(a['frequency']),
+                np.atleast_1d(a['quality']), np.atleast_1d(a['gain']))
+            # Each point's transfer function is used once, so it is not
+            # put in the cache
+            row[:] = resonance.transfer_function.__wrapped__(
+                N, fs, tuple(w0.astype(float)), tuple(Q.astype(float)),
+                tuple(gain.astype(float)))
+        tfs *= spectrum
+        targets = np.fft.irfft(tfs, n=N, axis=-1)
+        del tfs
+        targets *= 1e-14
+        targets += background
+        for offset, target in enumerate(targets):
+            yield start + offset, target, witnesses, {}
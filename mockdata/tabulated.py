@@ -0,0 +1,166 @@
+from __future__ import division
+import hashlib
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from .mock_bg import compose_background
+from .utils import array_cache
+
+__all__ = ['TabulatedASD', 'measured_noise', 'srd_file']
+
+# Design sensitivity curve shipped with the repository
+srd_file = os.path.join(os.path.dirname(__file__), os.pardir, 'Data',
+                        'SRD_25W.mat')
+
+
+class TabulatedASD(object):
+    '''
+    ASD given as a table of frequencies and values, usable anywhere a
+    noise component callable is: `compose_background` components,
+    `nonstationary_noise` shapes, and `measured_noise`.
+
+    Frequencies are interpolated linearly in log-log space. Outside the
+    table the end values are held. Interpolations onto ``rfft`` grids are
+    cached per (table contents, length, fs); see `rfft_asd`. Tables with
+    the same contents compare equal, and instances can be pickled, e.g.
+    to worker processes.
+
+    Parameters
+    ----------
+    freqs : array_like
+        Increasing positive frequencies in Hz.
+    asd : array_like
+        ASD at `freqs`, in 1/sqrt(Hz).
+    scale : float
+        Factor applied to the ASD. Defaults to 1.
+    '''
+    def __init__(self, freqs, asd, scale=1):
+        freqs = np.asarray(freqs, dtype=float).ravel()
+        asd = scale * np.asarray(asd, dtype=float).ravel()
+        if freqs.size != asd.size or freqs.size < 2:
+            raise ValueError('Need matching frequency and ASD columns of at '
+                             'least two rows')
+        if np.any(freqs <= 0) or np.any(np.diff(freqs) <= 0):
+            raise ValueError('Frequencies must be positive and increasing')
+        if np.any(asd <= 0):
+            raise ValueError('ASD must be positive for log interpolation')
+
+        self.freqs = freqs
+        self.asd = asd
+        self.key = hashlib.sha1(freqs.tobytes() + asd.tobytes()).hexdigest()
+        self._log_f = np.log(freqs)
+        self._log_asd = np.log(asd)
+
+    @classmethod
+    def from_file(cls, filename=srd_file, f_key='f', asd_key='x', scale=1):
+        '''
+        Read a table from a '.mat' or '.npz' file with `f_key` and
+        `asd_key` entries (as in Data/SRD_25W.mat), or from a text file of
+        two columns. Reads are cached until the file changes.
+        '''
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        freqs, asd = _read_table(filename, stat.st_mtime_ns, stat.st_size,
+                                 f_key, asd_key)
+        return cls(freqs, asd, scale=scale)
+
+    def __call__(self, freqs):
+        return _interp_loglog(np.asarray(freqs, dtype=float), self._log_f,
+                              self._log_asd)
+
+    def rfft_asd(self, n, fs):
+        '''
+        ASD on the `rfft` frequency grid of an `n`-sample series at `fs`.
+        Cached; the returned array is read-only.
+        '''
+        return _rfft_asd(self, int(n), fs)
+
+    def __eq__(self, other):
+        return isinstance(other, TabulatedASD) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'TabulatedASD({} points, {:g}-{:g} Hz)'.format(
+            self.freqs.size, self.freqs[0], self.freqs[-1])
+
+
+def measured_noise(sec, fs, asd=None, catalog=(), seed=None, out=None):
+    '''
+    Generate stationary noise with a tabulated ASD.
+
+    A thin wrapper of `compose_background` with one `TabulatedASD`
+    component, so it is synthesized in a single inverse FFT, and repeated
+    realizations reuse the interpolated ASD.
+
+    Parameters
+    ----------
+    sec, fs, seed, out
+        As for `compose_background`.
+    asd : TabulatedASD, str or array_like, optional
+        The ASD: a table, a file for `TabulatedASD.from_file`, or a two
+        column (frequency, ASD) array. Defaults to Data/SRD_25W.mat.
+    catalog : recarray or sequence of recarray
+        Lines to add, as for `compose_background`. Defaults to none.
+
+    Returns
+    -------
+    data : ndarray, shape (sec*fs,)
+        Time series with the tabulated ASD.
+    '''
+    if asd is None:
+        asd = TabulatedASD.from_file()
+    elif isinstance(asd, str):
+        asd = TabulatedASD.from_file(asd)
+    elif not isinstance(asd, TabulatedASD):
+        table = np.asarray(asd, dtype=float)
+        asd = TabulatedASD(table[:, 0], table[:, 1])
+    return compose_background(sec, fs, components=[asd], catalog=catalog,
+                              seed=seed, out=out)
+
+
+def _interp_loglog(freqs, log_f, log_asd):
+    '''
+    Log-log interpolation of a table at `freqs`, holding the end values.
+    '''
+    out = np.empty(freqs.shape)
+    pos = freqs > 0
+    out[~pos] = np.exp(log_asd[0])
+    out[pos] = np.exp(np.interp(np.log(freqs[pos]), log_f, log_asd))
+    return out
+
+
+@array_cache(2**28)
+def _rfft_asd(table, n, fs):
+    # Keyed by the table contents, through its hash and equality
+    asd = _interp_loglog(np.fft.rfftfreq(n, d=1 / fs), table._log_f,
+                         table._log_asd)
+    asd.flags.writeable = False
+    return asd
+
+
+@lru_cache(maxsize=16)
+def _read_table(filename, mtime, size, f_key, asd_key):
+    '''
+    Frequency and ASD columns of a table file. `mtime` and `size` only
+    key the cache.
+    '''
+    if filename.endswith('.mat'):
+        from scipy.io import loadmat
+        data = loadmat(filename)
+    elif filename.endswith('.npz'):
+        data = dict(np.load(filename))
+    else:
+        table = np.loadtxt(filename)
+        data = {f_key: table[:, 0], asd_key: table[:, 1]}
+    freqs = np.asarray(data[f_key], dtype=float).ravel()
+    asd = np.asarray(data[asd_key], dtype=float).ravel()
+    freqs.flags.writeable = False
+    asd.flags.writeable = False
+    return freqs, asd
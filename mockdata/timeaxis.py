@@ -0,0 +1,130 @@
+from __future__ import division
+import numbers
+
+import numpy as np
+
+__all__ = ['TimeAxis']
+
+
+class TimeAxis(object):
+    '''
+    Evenly sampled time axis, t0 + arange(n) / fs, stored as three numbers.
+
+    Behaves like the equivalent read-only array where it matters: it has a
+    length and shape, integer indexing gives a float, and slicing with a
+    positive step gives another `TimeAxis`. Anything else (fancy indexing,
+    `np.asarray`, numpy functions, plotting) materializes the samples on
+    demand, so the times cost no memory unless someone asks for them.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples.
+    fs : float
+        Sampling frequency in Hz.
+    t0 : float
+        Time of the first sample in seconds. Defaults to 0.
+    '''
+    ndim = 1
+    dtype = np.dtype(float)
+
+    def __init__(self, n, fs, t0=0):
+        if n < 0:
+            raise ValueError('Number of samples must be >=0')
+        if fs <= 0:
+            raise ValueError('Sampling frequency must be >0')
+        self.n = int(n)
+        self.fs = fs
+        self.t0 = t0
+
+    @classmethod
+    def from_seconds(cls, sec, fs, t0=0):
+        '''
+        Axis covering `sec` seconds at `fs` Hz, like
+        ``np.linspace(t0, t0 + sec, int(sec * fs), endpoint=False)``.
+        '''
+        return cls(int(sec * fs), fs, t0)
+
+    @property
+    def dt(self):
+        return 1 / self.fs
+
+    @property
+    def duration(self):
+        return self.n / self.fs
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    @property
+    def size(self):
+        return self.n
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return 'TimeAxis(n={}, fs={}, t0={})'.format(self.n, self.fs, self.t0)
+
+    def __eq__(self, other):
+        if not isinstance(other, TimeAxis):
+            return NotImplemented
+        return (self.n, self.fs, self.t0) == (other.n, other.fs, other.t0)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            if key < 0:
+                key += self.n
+            if not 0 <= key < self.n:
+                raise IndexError('Index out of range for {} samples'
+                                 .format(self.n))
+            return self.t0 + key / self.fs
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n)
+            if step > 0:
+                n = len(range(start, stop, step))
+                return TimeAxis(n, self.fs / step, self.t0 + start / self.fs)
+        return self.values()[key]
+
+    def __iter__(self):
+        for ii in range(self.n):
+            yield self.t0 + ii / self.fs
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values(dtype)
+
+    def values(self, dtype=float):
+        '''
+        Materialize the samples as an array.
+        '''
+        return (self.t0 + np.arange(self.n) / self.fs).astype(dtype,
+                                                              copy=False)
+
+    def __add__(self, other):
+        if isinstance(other, numbers.Real):
+            return TimeAxis(self.n, self.fs, self.t0 + other)
+        return self.values() + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, numbers.Real):
+            return TimeAxis(self.n, self.fs, self.t0 - other)
+        return self.values() - other
+
+    def __rsub__(self, other):
+        return other - self.values()
+
+    def index(self, t):
+        '''
+        Index of the sample closest to time `t`. Works on arrays of times
+        too; the result is not clipped to the axis.
+        '''
+        return np.round((np.asarray(t) - self.t0) * self.fs).astype(int)
@@ -0,0 +1,337 @@
+from __future__ import division
+import json
+import os
+
+import numpy as np
+
+from .container import container_ext, load_container
+from .mock_bg import _component_asd
+
+__all__ = ['validate', 'validate_file']
+
+# Names a dataset may use for each kind of array: `starting_data` and the
+# generation service use the first, makeNoise.py the second
+_aliases = {
+    'target': ('target', 'darm'),
+    'witnesses': ('witnesses', 'wit'),
+    'background': ('background',),
+}
+
+# Bands of the background ASD check and of the coherence check, in Hz
+asd_bands_d = [(10, 30), (30, 100), (100, 300), (300, 1000)]
+coherence_bands_d = [(5, 30), (30, 100), (100, 300)]
+
+
+def validate(data, fs, norm_freq=100, norm_amp=2.2e-20, zeros=None,
+             poles=None, asd_bands=None, coherence_bands=None, tfft=4,
+             asd_tol=0.3, clip_count=4):
+    '''
+    Check a generated dataset in a single pass over its arrays.
+
+    The arrays are read one segment of `tfft` seconds at a time, so memory
+    maps are streamed from disk rather than loaded. Along the way this
+    accumulates, for every channel, the mean and standard deviation, the
+    number of NaN and infinite samples, and how many samples sit at the
+    channel's extreme values, which flags clipping. Hann windowed segments
+    give Welch estimates (without overlap) of the background and target
+    PSDs, and of the witness-target cross spectra in the coherence bands.
+
+    The background ASD is compared to the `bucket_noise` shape given by
+    `norm_freq`, `norm_amp`, `zeros` and `poles`: in each band, the
+    median ratio of measured to expected PSD, which lines barely move, is
+    corrected for its estimation bias and reported as an ASD ratio.
+
+    Parameters
+    ----------
+    data : mapping
+        Arrays of the dataset: 'target' (or 'darm'), 'witnesses' (or
+        'wit'), and optionally 'background'. Any other keys are ignored.
+    fs : float
+        Sampling frequency in Hz.
+    norm_freq, norm_amp, zeros, poles
+        Expected background shape, as for `bucket_noise`.
+    asd_bands : list of (float, float), optional
+        Bands of the ASD check in Hz. Bands reaching past 0.8 times the
+        Nyquist frequency are cut there, or dropped.
+    coherence_bands : list of (float, float), optional
+        Bands over which witness-target coherence is averaged.
+    tfft : float
+        Segment length in seconds. Defaults to 4 s.
+    asd_tol : float
+        Allowed relative deviation of the background ASD. Defaults to 0.3.
+    clip_count : int
+        Number of samples at a channel's maximum (or minimum) from which
+        it is reported as clipped. Defaults to 4.
+
+    Returns
+    -------
+    report : dict
+        JSON serializable summary. 'ok' is False if any check failed, and
+        'problems' says which.
+    '''
+    arrays = {}
+    for name, aliases in _aliases.items():
+        for alias in aliases:
+            if alias in data:
+                arrays[name] = data[alias]
+                break
+    if 'target' not in arrays:
+        raise ValueError('Dataset has no target array')
+
+    channels = {name: np.atleast_2d(arr) for name, arr in arrays.items()}
+    N = channels['target'].shape[-1]
+    problems = []
+    for name, arr in channels.items():
+        if arr.shape[-1] != channels['target'].shape[-1]:
+            problems.append('{} has {} samples, the target {}'.format(
+                name, arr.shape[-1], channels['target'].shape[-1]))
+            N = min(N, arr.shape[-1])
+
+    L = int(tfft * fs)
+    freqs = np.fft.rfftfreq(L, d=1 / fs)
+    window = np.hanning(L)
+    # One-sided PSD normalization of a windowed segment
+    wscale = 2 / (fs * np.sum(window**2))
+
+    fmax = 0.8 * fs / 2
+    if asd_bands is None:
+        asd_bands = asd_bands_d
+    asd_bands = [(lo, min(hi, fmax)) for lo, hi in asd_bands if lo < fmax]
+    if coherence_bands is None:
+        coherence_bands = coherence_bands_d
+    coherence_bands = [(lo, hi) for lo, hi in coherence_bands
+                       if lo < fs / 2]
+    coh_bins = np.zeros(freqs.size, dtype=bool)
+    for lo, hi in coherence_bands:
+        coh_bins |= (freqs >= lo) & (freqs < hi)
+    coh_freqs = freqs[coh_bins]
+
+    stats = {name: _Moments(arr.shape[0]) for name, arr in channels.items()}
+    psd = {name: np.zeros(freqs.size)
+           for name in ('target', 'background') if name in channels}
+    n_wit = channels['witnesses'].shape[0] if 'witnesses' in channels else 0
+    s_xy = np.zeros((n_wit, coh_freqs.size), dtype=np.complex128)
+    s_xx = np.zeros((n_wit, coh_freqs.size))
+    segments = 0
+    skipped = 0
+
+    for start in range(0, N, L):
+        stop = min(start + L, N)
+        block = {name: np.asarray(arr[:, start:stop], dtype=float)
+                 for name, arr in channels.items()}
+        finite = True
+        for name, x in block.items():
+            finite &= stats[name].update(x)
+
+        if stop - start < L:
+            continue
+        if not finite:
+            skipped += 1
+            continue
+        segments += 1
+        spectra = {name: np.fft.rfft(window * block[name][0])
+                   for name in psd}
+        for name, X in spectra.items():
+            psd[name] += np.abs(X)**2
+        if n_wit:
+            T = spectra['target'][coh_bins]
+            W = np.fft.rfft(window * block['witnesses'], axis=-1)[:, coh_bins]
+            s_xy += W.conj() * T
+            s_xx += np.abs(W)**2
+
+    report = {
+        'fs': fs,
+        'n': N,
+        'duration': N / fs,
+        'tfft': tfft,
+        'segments': segments,
+        'skipped_segments': skipped,
+        'channels': {},
+    }
+
+    for name, moments in stats.items():
+        summary = moments.summary(clip_count)
+        report['channels'][name] = summary if name == 'witnesses' else \
+            {key: value[0] for key, value in summary.items()}
+        if sum(summary['nan']) or sum(summary['inf']):
+            problems.append('{} has {} NaN and {} infinite samples'.format(
+                name, sum(summary['nan']), sum(summary['inf'])))
+        clipped = [ii for ii, c in enumerate(summary['clipped']) if c]
+        if clipped:
+            problems.append('{} clipped in rows {}'.format(name, clipped))
+        constant = [ii for ii, s in enumerate(summary['std']) if s == 0]
+        if constant:
+            problems.append('{} constant in rows {}'.format(name, constant))
+
+    if segments == 0:
+        problems.append('No complete finite segment of {} s'.format(tfft))
+        report['problems'] = problems
+        report['ok'] = False
+        return report
+
+    for name in psd:
+        psd[name] *= wscale / segments
+    # The median of an average of `segments` periodograms, over the mean
+    bias = (1 - 1 / (9 * segments))**3
+
+    if 'background' in psd:
+        expected = _component_asd(freqs, {'norm_freq': norm_freq,
+                                          'norm_amp': norm_amp,
+                                          'zeros': zeros, 'poles': poles})**2
+        checks = []
+        for lo, hi in asd_bands:
+            sel = (freqs >= lo) & (freqs < hi)
+            if not np.any(sel):
+                continue
+            ratio = np.sqrt(np.median(psd['background'][sel] /
+                                      expected[sel]) / bias)
+            excess = np.sqrt(np.median(psd['target'][sel] /
+                                       psd['background'][sel]))
+            ok = 1 / (1 + asd_tol) <= ratio <= 1 + asd_tol
+            checks.append({'band': [lo, hi], 'asd_ratio': float(ratio),
+                           'target_excess': float(excess), 'ok': bool(ok)})
+            if not ok:
+                problems.append('Background ASD off by {:.3g}x in {}-{} Hz'
+                                .format(ratio, lo, hi))
+        report['asd'] = checks
+
+    if n_wit:
+        coh = np.abs(s_xy)**2 / (s_xx * psd['target'][coh_bins] / wscale *
+                                 segments)
+        bands = []
+        for lo, hi in coherence_bands:
+            sel = (coh_freqs >= lo) & (coh_freqs < hi)
+            band_coh = np.mean(coh[:, sel], axis=-1) if np.any(sel) else \
+                np.full(n_wit, np.nan)
+            bands.append({'band': [lo, hi], 'mean': band_coh.tolist(),
+                          'max': float(np.max(band_coh))})
+        # Coherence of unrelated channels averages to about this
+        report['coherence'] = {'bands': bands, 'floor': 1 / segments}
+
+    report['problems'] = problems
+    report['ok'] = not problems
+    return report
+
+
+def validate_file(path, fs=None, **kwargs):
+    '''
+    Run `validate` on a saved dataset: a '.npz' file, a chunked container
+    (see `container.save_container`), a '.mat' file as written by
+    makeNoise.py, or a directory of '.npy' files such as a cache entry of
+    the generation service, which are memory-mapped.
+
+    `fs` is read from the dataset if not given. Other keywords are passed
+    on to `validate`. The report also gets the 'path'.
+    '''
+    meta = {}
+    if os.path.isdir(path):
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        data = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                for name in os.listdir(path) if name.endswith('.npy')}
+    elif path.endswith('.npz'):
+        data = np.load(path)
+    elif path.endswith(container_ext):
+        data = load_container(path)
+    else:
+        # makeNoise.py output, which may lack the '.mat' suffix
+        from scipy.io import loadmat
+        data = {name: np.squeeze(value)
+                for name, value in loadmat(path).items()
+                if not name.startswith('__')}
+        if 'wit' in data:
+            data['wit'] = np.atleast_2d(data['wit'])
+
+    if fs is None:
+        if 'fs' in meta:
+            fs = meta['fs']
+        elif 'fs' in data:
+            fs = float(np.squeeze(data['fs']))
+        else:
+            raise ValueError('No sampling frequency in {}'.format(path))
+
+    report = validate(data, fs, **kwargs)
+    report['path'] = path
+    return report
+
+
+class _Moments(object):
+    '''
+    Running per-row statistics of a stream of (rows, n) blocks. Means and
+    variances are merged block by block, which stays accurate for data far
+    from zero mean.
+    '''
+    def __init__(self, rows):
+        self.n = np.zeros(rows)
+        self.mean = np.zeros(rows)
+        self.m2 = np.zeros(rows)
+        self.nan = np.zeros(rows, dtype=int)
+        self.inf = np.zeros(rows, dtype=int)
+        self.max = np.full(rows, -np.inf)
+        self.min = np.full(rows, np.inf)
+        self.n_max = np.zeros(rows, dtype=int)
+        self.n_min = np.zeros(rows, dtype=int)
+
+    def update(self, x):
+        '''
+        Add a block. Returns whether it was all finite.
+        '''
+        isnan = np.isnan(x)
+        isinf = np.isinf(x)
+        self.nan += isnan.sum(axis=-1)
+        self.inf += isinf.sum(axis=-1)
+        finite = not (isnan.any() or isinf.any())
+        if not finite:
+            x = np.where(isnan | isinf, np.nan, x)
+
+        n = np.sum(~np.isnan(x), axis=-1) if not finite else \
+            np.full(x.shape[0], x.shape[-1])
+        if np.all(n == 0):
+            return finite
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nanmean(x, axis=-1) if not finite else x.mean(axis=-1)
+        mean = np.where(n > 0, mean, 0)
+        dev = x - mean[:, np.newaxis]
+        m2 = np.nansum(dev * dev, axis=-1)
+
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0)
+            self.m2 += m2 + np.where(total > 0,
+                                     delta**2 * self.n * n / total, 0)
+        self.n = total
+
+        block_max = np.nanmax(np.where(n[:, np.newaxis] > 0, x, -np.inf),
+                              axis=-1)
+        block_min = np.nanmin(np.where(n[:, np.newaxis] > 0, x, np.inf),
+                              axis=-1)
+        at_max = np.sum(x == block_max[:, np.newaxis], axis=-1)
+        at_min = np.sum(x == block_min[:, np.newaxis], axis=-1)
+        self.n_max = np.where(block_max > self.max, at_max,
+                              self.n_max + np.where(block_max == self.max,
+                                                    at_max, 0))
+        self.n_min = np.where(block_min < self.min, at_min,
+                              self.n_min + np.where(block_min == self.min,
+                                                    at_min, 0))
+        self.max = np.maximum(self.max, block_max)
+        self.min = np.minimum(self.min, block_min)
+        return finite
+
+    def summary(self, clip_count):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2 / self.n)
+        # A constant channel is reported as such, not as clipped
+        varies = self.max > self.min
+        return {
+            'mean': self.mean.tolist(),
+            'std': std.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'nan': self.nan.tolist(),
+            'inf': self.inf.tolist(),
+            'clipped': (varies & ((self.n_max >= clip_count) |
+                                  (self.n_min >= clip_count))).tolist(),
+        }